@@ -0,0 +1,58 @@
+# asyncio variants of the retrieval functions of ch02, ch03 and ch07. They take an AsyncDriver
+# (utils.get_async_driver), keep the signatures and catalog queries of their synchronous counterparts
+# and return awaitables, so one event loop can keep many retrievals and LLM calls in flight.
+import asyncio
+
+import neo4j
+
+from ch07_tools import get_local_system_prompt
+from projection import project_for_index
+from query_catalog import catalog
+from utils import achat, get_embedding_service, query_embedding_cache
+
+
+async def embed_query(question: str, model: str = "all-MiniLM-L12-v2"):
+    """Like utils.embed_query, but awaits the shared micro-batching service instead of blocking a thread."""
+    embedding = query_embedding_cache.get(question, model)
+    if embedding is None:
+        embedding = await asyncio.wrap_future(get_embedding_service(model).submit(question))
+        query_embedding_cache.put(question, model, embedding)
+    return embedding
+
+
+async def vector_similarity_search(driver: neo4j.AsyncDriver, index_name, k=5, question_embedding=None):
+    similar_records, _, _ = await catalog.arun(driver, "vector_search", index_name=index_name, k=k, question_embedding=question_embedding)
+    return similar_records
+
+
+async def hybrid_search(driver: neo4j.AsyncDriver, index_name, full_text_index_name, question, k=5, question_embedding=None):
+    similar_hybrid_records, _, _ = await catalog.arun(driver, "hybrid_search",
+                                                      index_name=index_name,
+                                                      full_text_index_name=full_text_index_name,
+                                                      k=k,
+                                                      question_embedding=question_embedding,
+                                                      question=question)
+    return similar_hybrid_records
+
+
+async def parent_retrieval(driver: neo4j.AsyncDriver, question, index_name):
+    question_embedding = project_for_index(index_name, await embed_query(question, "all-MiniLM-L12-v2"))
+    similar_records, _, _ = await catalog.arun(driver, "parent_retrieval", index_name=index_name, question_embedding=question_embedding, k=10)
+    return [record["text"] for record in similar_records]
+
+
+async def local_search(driver: neo4j.AsyncDriver, query: str, k: int = 5, top_chunks: int = 3, top_communities: int = 3, top_inside_rels: int = 3) -> str:
+    context, _, _ = await catalog.arun(driver, "local_search",
+                                       k=k,
+                                       topChunks=top_chunks,
+                                       topCommunities=top_communities,
+                                       topInsideRels=top_inside_rels,
+                                       embedding=project_for_index("entities", await embed_query(query, model="all-MiniLM-L12-v2"))
+                                       )
+    context_str = str(context[0]["text"])
+    messages = [
+        {"role": "system", "content": get_local_system_prompt(context_str)},
+        {"role": "user", "content": query}
+    ]
+    response = await achat(messages, model="gpt-4o")
+    return context_str, response
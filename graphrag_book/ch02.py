@@ -1,93 +1,108 @@
 import requests
-import pdfplumber
-from utils import chunk_text
+from utils import as_vector, chunk_offsets, embed_batch, embed_query, get_driver, write_in_batches
+from ingestion import batched, iter_text_chunks, run_stages
+from write_executor import WriteExecutor
+from source_store import get_source_store
+from pdf_utils import extract_pdf_text, iter_pdf_pages, page_for_offset
+from graph_schema import ensure_ingestion_schema
+from query_catalog import catalog
+from vector_index import ensure_vector_index
+from projection import fit_projection_for_index, clear_projection_for_index, project_for_index
 from openai import OpenAI
 import os
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
 load_dotenv(override=True)
 
 open_ai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 remote_pdf_url = "https://arxiv.org/pdf/1709.00666.pdf"
+pdf_id = "1709.00666"
 prf_filename = "ch02-downloaded.pdf"
 
-def download_and_create_pdf_chunks(url: str, pdf_name: str, chunk_size: int, overlap: int, split_on_whitespaces: bool = True) -> list[str]:
-    response = requests.get(url)
-    if response.status_code == 200:
-        with open(pdf_name, "wb") as f:
-            f.write(response.content)
-        with pdfplumber.open(pdf_name) as pdf:
-            text = ""
-            for page in pdf.pages:
-                text += page.extract_text()
-            return chunk_text(text, chunk_size, overlap, split_on_whitespaces)
-    else:
-        print(f"Failed to download PDF from {url}")
-        return []
+def download_and_create_pdf_chunks(url: str, pdf_name: str, chunk_size: int, overlap: int, split_on_whitespaces: bool = True) -> tuple[list[str], list[int]]:
+    """Return the chunks of the PDF and the 0-based page each chunk starts on."""
+    try:
+        get_source_store().fetch_to(url, pdf_name)
+    except (requests.RequestException, FileNotFoundError) as e:
+        print(f"Failed to download PDF from {url}: {e}")
+        return [], []
+    text, page_offsets = extract_pdf_text(pdf_name)
+    spans = list(chunk_offsets(text, chunk_size, overlap, split_on_whitespaces))
+    return [text[start:end] for start, end in spans], [page_for_offset(page_offsets, start) for start, _ in spans]
     
-def embed(text, model):
-    if model == "text-embedding-3-small":  
-        response = open_ai_client.embeddings.create(
-            input=text,
-            model="text-embedding-3-small"
-        )
-        return list(map(lambda x: x.embedding, response.data))
-    elif model == "all-MiniLM-L12-v2":
-        model = SentenceTransformer("all-MiniLM-L12-v2")
-        return list(map(lambda x: model.encode(x), text))
+def create_neo4j_index(driver, index_name, model = "all-MiniLM-L12-v2", **options):
+    # Dimensions come from the model or the index projection; options are the HNSW/quantization settings.
+    # With quantization=True, search with rescored_similarity_search to rescore against the full vectors.
+    return ensure_vector_index(driver, index_name, "Chunk", model, **options)
 
-from neo4j import GraphDatabase
+import_chunks_query = """
+UNWIND $rows AS row
+MERGE (c:Chunk {doc_id: $doc_id, index: row.index})
+SET c.text = row.text, c.page = row.page
+WITH c, row
+CALL db.create.setNodeVectorProperty(c, 'embedding', row.embedding)
+"""
 
-def create_neo4j_index(driver, index_name, embeddings):
-    driver.execute_query(
-        f"""CREATE VECTOR INDEX {index_name} IF NOT EXISTS
-        FOR (c:Chunk)
-        ON (c.embedding)
-        OPTIONS {{
-            indexConfig: {{
-                `vector.dimensions`: {len(embeddings[0])},
-                `vector.similarity_function`: 'cosine'
-            }}
-        }}"""
-    )
-
-def store_chunks_and_populate_index(driver, chunks, embeddings):
-    driver.execute_query(
-        """
-        WITH $chunks as chunks, range(0, size($chunks)) AS index
-        UNWIND index AS i
-        WITH i, chunks[i] AS chunk, $embeddings[i] AS embedding
-        MERGE (c:Chunk {index: i})
-        SET c.text = chunk, c.embedding = embedding
-        """,
-        chunks=chunks, 
-        embeddings=embeddings
+def store_chunks_and_populate_index(driver, chunks, embeddings, batch_size: int = 500, doc_id: str = pdf_id, index_name: str = "pdf", pages: list[int] = None):
+    ensure_ingestion_schema(driver, ["Chunk"])
+    embeddings = project_for_index(index_name, embeddings)
+    write_in_batches(
+        driver,
+        import_chunks_query,
+        ({"index": i, "text": chunk, "page": pages[i] if pages is not None else None, "embedding": as_vector(embedding)}
+         for i, (chunk, embedding) in enumerate(zip(chunks, embeddings))),
+        batch_size,
+        doc_id=doc_id
     )
     
-def get_data_form_chunk(driver, chunk_index):
-    results, _, _ = driver.execute_query(
-        f"""
-        MATCH (c:Chunk)
-        WHERE c.index = {chunk_index}
-        RETURN c.text AS text, c.embedding AS embedding
-        """
-    )
+def stream_pdf_to_neo4j(driver, url: str, pdf_name: str, chunk_size: int, overlap: int, model: str = "all-MiniLM-L12-v2", embed_batch_size: int = 64, write_batch_size: int = 256, write_workers: int = 4, queue_size: int = 4, doc_id: str = pdf_id, index_name: str = "pdf") -> int:
+    """
+    Streaming alternative to download_and_create_pdf_chunks + embed + store_chunks_and_populate_index.
+    Pages are chunked as they are extracted, embedding runs in its own thread and writes on write_workers
+    concurrent sessions, all behind bounded queues, so memory stays flat and writes start as soon as the
+    first batch is embedded.
+    """
+    try:
+        get_source_store().fetch_to(url, pdf_name)
+    except (requests.RequestException, FileNotFoundError) as e:
+        print(f"Failed to download PDF from {url}: {e}")
+        return 0
+    ensure_ingestion_schema(driver, ["Chunk"])
+
+    # Pages are the pieces fed to the chunker, so each chunk comes with the page it starts on
+    chunks = enumerate(iter_text_chunks(iter_pdf_pages(pdf_name), chunk_size, overlap, with_pages=True))
+
+    def embed_stage(batch):
+        embeddings = project_for_index(index_name, embed_batch([chunk for _, (chunk, _) in batch], model, batch_size=embed_batch_size))
+        return [{"index": i, "text": chunk, "page": page, "embedding": as_vector(embedding)}
+                for (i, (chunk, page)), embedding in zip(batch, embeddings)]
+
+    # Re-batch the embedded rows so write and embedding batch sizes can differ
+    embedded = run_stages(batched(chunks, embed_batch_size), [embed_stage], queue_size)
+    total = 0
+    with WriteExecutor(driver, workers=write_workers, queue_size=queue_size) as executor:
+        for rows in batched((row for rows in embedded for row in rows), write_batch_size):
+            executor.submit_query(import_chunks_query, rows=rows, doc_id=doc_id)
+            total += len(rows)
+    return total
+
+def get_data_form_chunk(driver, chunk_index, doc_id: str = pdf_id):
+    results, _, _ = catalog.run(driver, "chunk_by_index", doc_id=doc_id, chunk_index=chunk_index)
     return results[0]["text"], results[0]["embedding"]
 
-def embed_question(question, model):
-    question_embedding = embed([question], model)
-    return question_embedding[0]
+def embed_question(question, model, index_name = None):
+    question_embedding = embed_query(question, model)
+    # Queries have to go through the same projection as the vectors stored in the index
+    return project_for_index(index_name, question_embedding) if index_name else question_embedding
 
 def vector_similarity_search(driver, index_name, k = 5, question_embedding = None):
-    similar_records, _, _ = driver.execute_query(
-        f"""
-        CALL db.index.vector.queryNodes('{index_name}', $k, $question_embedding) YIELD node AS hits, score
-        RETURN hits.text AS text, score, hits.index AS index
-        """,
-        k=k,
-        question_embedding=question_embedding
-    )
+    similar_records, _, _ = catalog.run(driver, "vector_search", index_name=index_name, k=k, question_embedding=question_embedding)
+    return similar_records
+
+def rescored_similarity_search(driver, index_name, k = 5, question_embedding = None, oversample = 4):
+    # First pass over the quantized index, exact cosine rescoring of the top k * oversample candidates
+    similar_records, _, _ = catalog.run(driver, "rescored_vector_search", index_name=index_name, k=k,
+                                        oversample=oversample, question_embedding=question_embedding)
     return similar_records
 
 def generate_answer(similar_records, question):
@@ -162,46 +177,36 @@ def create_full_text_index(driver):
     )
 
 def hybrid_search(driver, index_name, full_text_index_name, question, k = 5, question_embedding = None):
-    similar_hybrid_records, _, _ = driver.execute_query(
-        f"""
-        CALL {{
-            CALL db.index.vector.queryNodes('{index_name}', $k, $question_embedding) YIELD node, score
-            WITH collect({{node:node, score:score}}) AS nodes, max(score) AS max
-            UNWIND nodes AS n
-            //normalize scores
-            RETURN n.node AS node, (n.score / max) AS score
-            UNION
-            //keyword index
-            CALL db.index.fulltext.queryNodes('{full_text_index_name}', $question, {{limit: $k}}) YIELD node, score
-            WITH collect({{node:node, score:score}}) AS nodes, max(score) AS max
-            UNWIND nodes AS n
-            RETURN n.node AS node, (n.score / max) AS score
-        }}
-        //deduplicate nodes
-        WITH node, max(score) AS score ORDER BY score DESC LIMIT $k
-        RETURN node, score
-        """,
-        k=k,
-        question_embedding=question_embedding,
-        question=question
-    )
+    similar_hybrid_records, _, _ = catalog.run(driver, "hybrid_search",
+                                               index_name=index_name,
+                                               full_text_index_name=full_text_index_name,
+                                               k=k,
+                                               question_embedding=question_embedding,
+                                               question=question)
     return similar_hybrid_records
     
 if __name__ == "__main__":
-    chunks = download_and_create_pdf_chunks(remote_pdf_url, prf_filename, 500, 40, True)
-    embeddings = embed(chunks, "all-MiniLM-L12-v2")
+    chunks, pages = download_and_create_pdf_chunks(remote_pdf_url, prf_filename, 500, 40, True)
+    embeddings = embed_batch(chunks, "all-MiniLM-L12-v2")
     print(f"Number of chunks: {len(chunks)}")
     print(f"Number of embeddings: {len(embeddings)}")
-    print(f"Number of embedding dimensions: {len(embeddings[0])}")
+    # Optionally reduce the vectors (e.g. EMBEDDING_DIMENSIONS=128) before they reach the index
+    if os.getenv("EMBEDDING_DIMENSIONS"):
+        # store_chunks_and_populate_index applies the saved projection to the vectors it writes
+        fit_projection_for_index("pdf", embeddings, int(os.getenv("EMBEDDING_DIMENSIONS")), "all-MiniLM-L12-v2")
+    else:
+        clear_projection_for_index("pdf")
+    print(f"Number of embedding dimensions: {len(project_for_index('pdf', embeddings[:1])[0])}")
     #print(f"First embedding: {embeddings[0]}")
-    driver = GraphDatabase.driver(os.getenv("NEO4J_URI"), auth=(os.getenv("NEO4J_USERNAME"), os.getenv("NEO4J_PASSWORD")))
-    create_neo4j_index(driver, "pdf", embeddings)
-    store_chunks_and_populate_index(driver, chunks, embeddings)
+    driver = get_driver()
+    catalog.warmup(driver)
+    create_neo4j_index(driver, "pdf", "all-MiniLM-L12-v2")
+    store_chunks_and_populate_index(driver, chunks, embeddings, pages=pages)
     text, embedding = get_data_form_chunk(driver, 0)
     #print(f"Text: {text}")
     #print(f"Embedding: {embedding}")
     question = "At what time was Einstein really interested in experimental works?"
-    question_embedding = embed_question(question, "all-MiniLM-L12-v2")
+    question_embedding = embed_question(question, "all-MiniLM-L12-v2", "pdf")
     similar_records = vector_similarity_search(driver, "pdf", 5, question_embedding)
     # for record in similar_records:
     #     print(f"Text: {record['text']}")
@@ -214,4 +219,3 @@ if __name__ == "__main__":
     #print(f"similar_hybrid_records: {similar_hybrid_records}")
     answer = generate_answer(similar_hybrid_records, question)
     
-    driver.close()
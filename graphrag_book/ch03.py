@@ -1,13 +1,19 @@
 import dotenv
+import json
 import re
 from typing import List
 
-import pdfplumber
 import requests
 from openai import OpenAI
 import os
-import tiktoken
-from utils import chunk_text, chat, neo4j_driver, embed, clear_existing_data, drop_vector_index
+from utils import as_vector, chunk_offsets, chunk_text, chat, content_hash, num_tokens_from_string, get_driver, embed_batch, embed_query, write_in_batches
+from source_store import get_source_store
+from pdf_utils import extract_pdf_text, locate_chunks, page_for_offset
+from write_executor import WriteExecutor
+from graph_schema import ensure_ingestion_schema
+from query_catalog import catalog
+from vector_index import ensure_vector_index
+from projection import project_for_index
 
 from dotenv import load_dotenv
 
@@ -41,20 +47,14 @@ def generate_stepback_question(question):
     )
     return stepback_question
 
-def download_and_create_pdf(url: str, pdf_name: str) -> list[str]:
-    response = requests.get(url)
-    if response.status_code == 200:
-        with open(pdf_name, "wb") as f:
-            f.write(response.content)
-        with pdfplumber.open(pdf_name) as pdf:
-            text = ""
-            for page in pdf.pages:
-                text += page.extract_text()
-        return text
-    
-    else:
-        print(f"Failed to download PDF from {url}")
-        return []
+def download_and_create_pdf(url: str, pdf_name: str) -> tuple[str, list[int]]:
+    """Return the text of the PDF and the character offset at which each page starts."""
+    try:
+        get_source_store().fetch_to(url, pdf_name)
+    except (requests.RequestException, FileNotFoundError) as e:
+        print(f"Failed to download PDF from {url}: {e}")
+        return "", []
+    return extract_pdf_text(pdf_name)
     
 # parent document retrieval
 def split_text_by_title(text: str) -> list[str]:
@@ -70,9 +70,7 @@ def split_text_by_title(text: str) -> list[str]:
     return sections_with_titles
 
 def num_tokens_from_section(section: str, model: str = "gpt-4o-mini") -> int:
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(section)
-    return len(tokens)
+    return num_tokens_from_string(section, model)
 
 def create_parent_chunks(sections: list[str]) -> list[str]:
     parent_chunks = []
@@ -85,47 +83,181 @@ def create_parent_chunks(sections: list[str]) -> list[str]:
         #     parent_chunks.append(section)
     return parent_chunks
 
-def store_parent_chunks(driver, parent_chunks):
-    cypher_import_query = """
-    MERGE (pdf:PDF {id:$pdf_id})
-    MERGE (p:Parent {id:$pdf_id + '-' + $id})
-    SET p.text = $parent
-    MERGE (pdf)-[:HAS_PARENT]->(p)
-    WITH p, $children AS children, $embeddings as embeddings
-    UNWIND range(0, size(children) - 1) AS child_index
-    MERGE (c:Child {id: $pdf_id + '-' + $id + '-' + toString(child_index)})
-    SET c.text = children[child_index], c.embedding = embeddings[child_index]
-    MERGE (p)-[:HAS_CHILD]->(c);
+import_parents_query = """
+MERGE (pdf:PDF {id: $pdf_id})
+WITH pdf
+UNWIND $rows AS row
+MERGE (p:Parent {pdf_id: $pdf_id, id: row.id})
+SET p.text = row.text
+MERGE (pdf)-[:HAS_PARENT]->(p)
 """
-    #driver = neo4j_driver()
-    for i, chunk in enumerate(parent_chunks):
-        child_chunk = chunk_text(chunk, 500, 20)
-        embeddings = embed(child_chunk, "all-MiniLM-L12-v2")
-        driver.execute_query(cypher_import_query, 
-                             pdf_id="1709.00666", 
-                             parent=chunk,
-                             id = str(i),
-                             children=child_chunk, 
-                             embeddings=embeddings)
-    #driver.close()
-def create_vector_index_on_child_nodes(driver):
-    index_name = "parent"
-    try:
-        driver.execute_query(f"""CALL db.index.vector.createNodeIndex($index_name, 'Child', 'embedding', 384, 'cosine')""", index_name=index_name)
-    except Exception as e:
-        print(f"Error creating vector index on child nodes: {e}")
-
-def parent_retrieval(driver, question, index_name):
-    question_embedding = embed([question], "all-MiniLM-L12-v2")[0]
-    retrieval_query = """CALL db.index.vector.queryNodes($index_name, $k * 4, $question_embedding)
-                            YIELD node, score
-                            MATCH (node)<-[:HAS_CHILD]-(parent)
-                            WITH parent, max(score) AS score
-                            RETURN parent.text AS text, score
-                            ORDER BY score DESC
-                            LIMIT toInteger($k)
-                            """
-    similar_records, _, _ = driver.execute_query(retrieval_query, index_name=index_name, question_embedding=question_embedding, k=10)
+
+import_children_query = """
+UNWIND $rows AS row
+MATCH (p:Parent {pdf_id: $pdf_id, id: row.parent})
+MERGE (c:Child {pdf_id: $pdf_id, id: row.id})
+SET c.text = row.text, c.page = row.page
+MERGE (p)-[:HAS_CHILD]->(c)
+WITH c, row
+CALL db.create.setNodeVectorProperty(c, 'embedding', row.embedding)
+"""
+
+def child_pages(parent_start: int, parent: str, page_offsets: list[int]) -> list[int]:
+    """Page each child chunk of parent starts on, given the offset of parent in the document text."""
+    if not page_offsets:
+        return [None] * len(chunk_text(parent, 500, 20))
+    return [page_for_offset(page_offsets, parent_start + start) for start, _ in chunk_offsets(parent, 500, 20)]
+
+def store_parent_chunks(driver, parent_chunks, pdf_id: str = "1709.00666", batch_size: int = 500, workers: int = 4, index_name: str = "parent",
+                        text: str = "", page_offsets: list[int] = None):
+    """Store parents and their embedded children; with the document text and page_offsets, children record their page."""
+    child_chunks = [chunk_text(chunk, 500, 20) for chunk in parent_chunks]
+    parent_starts = locate_chunks(text, parent_chunks) if page_offsets else [0] * len(parent_chunks)
+    pages = [child_pages(start, chunk, page_offsets) for start, chunk in zip(parent_starts, parent_chunks)]
+    # Embed the children of all parents together so the encoder sees full batches
+    all_embeddings = iter(project_for_index(index_name, embed_batch([child for children in child_chunks for child in children], "all-MiniLM-L12-v2")))
+    parent_rows = [{"id": f"{pdf_id}-{i}", "text": chunk} for i, chunk in enumerate(parent_chunks)]
+    child_rows = [{"id": f"{pdf_id}-{i}-{j}", "parent": f"{pdf_id}-{i}", "text": child, "page": pages[i][j], "embedding": as_vector(next(all_embeddings))}
+                  for i, children in enumerate(child_chunks) for j, child in enumerate(children)]
+    # Children MATCH their parent, so all parents are written before the children are spread over the workers
+    ensure_ingestion_schema(driver, ["PDF", "Parent", "Child"])
+    write_in_batches(driver, import_parents_query, parent_rows, batch_size, pdf_id=pdf_id)
+    with WriteExecutor(driver, workers) as executor:
+        executor.submit_batches(import_children_query, child_rows, batch_size, pdf_id=pdf_id)
+
+# Bumped whenever the id scheme of build_manifest changes: ids in an older manifest do not
+# match the nodes it describes, so the document is rebuilt instead of diffed.
+MANIFEST_VERSION = 2
+
+def section_keys(sections: list[str]) -> list[str]:
+    """
+    Stable key of each section from the hash of its title without the section number, so
+    inserting or removing a section does not change the keys of the sections after it.
+    """
+    keys, seen = [], {}
+    for section_i, section in enumerate(sections):
+        # The first section is the text before the first title
+        title = "" if section_i == 0 else re.sub(r"^\d+[A-Z]?\.\s*", "", section.split("\n", 1)[0]).strip()
+        key = content_hash(title)[:12]
+        seen[key] = seen.get(key, 0) + 1
+        keys.append(key if seen[key] == 1 else f"{key}-{seen[key]}")
+    return keys
+
+def build_manifest(pdf_id: str, sections: list[str], model: str = "all-MiniLM-L12-v2", text: str = "", page_offsets: list[int] = None) -> dict:
+    """
+    Content-hash manifest of a document, its sections, parent chunks and child chunks.
+    Sections are keyed by their title (see section_keys) and chunk ids are positional within
+    their section, so an edit only changes the ids of that section. With the document text
+    and its page_offsets, children also record the page they start on.
+    """
+    # Page breaks are part of the document: moving them alone changes the children's pages
+    manifest = {"pdf_id": pdf_id, "model": model, "version": MANIFEST_VERSION, "document": content_hash("".join(sections) + json.dumps(page_offsets)),
+                "sections": {}, "parents": {}, "children": {}}
+    section_starts = locate_chunks(text, sections) if page_offsets else [0] * len(sections)
+    for section_key, section, section_start in zip(section_keys(sections), sections, section_starts):
+        section_id = f"{pdf_id}-{section_key}"
+        manifest["sections"][section_id] = content_hash(section)
+        for parent_i, (start, end) in enumerate(chunk_offsets(section, 2000, 40)):
+            parent, parent_id = section[start:end], f"{section_id}-{parent_i}"
+            manifest["parents"][parent_id] = {"hash": content_hash(parent), "text": parent}
+            pages = child_pages(section_start + start, parent, page_offsets)
+            for child_i, (child, page) in enumerate(zip(chunk_text(parent, 500, 20), pages)):
+                manifest["children"][f"{parent_id}-{child_i}"] = {"hash": content_hash(child), "parent": parent_id, "text": child, "page": page}
+    return manifest
+
+def diff_manifests(old: dict, new: dict, kind: str) -> tuple[list[str], list[str]]:
+    """Return the ids of the given kind ("parents" or "children") to upsert and to delete."""
+    upserts = [id for id, entry in new[kind].items() if old[kind].get(id, {}).get("hash") != entry["hash"]]
+    deletes = [id for id in old[kind] if id not in new[kind]]
+    return upserts, deletes
+
+def diff_child_pages(old: dict, new: dict) -> list[str]:
+    """Return the ids of the children whose text is unchanged but that now start on another page."""
+    return [id for id, entry in new["children"].items()
+            if id in old["children"] and old["children"][id]["hash"] == entry["hash"]
+            and old["children"][id].get("page") != entry["page"]]
+
+def load_manifest(manifest_path: str) -> dict:
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(manifest: dict, manifest_path: str):
+    # Texts are only needed while importing; the stored manifest keeps ids, hashes and pages
+    stored = {**manifest,
+              "parents": {id: {"hash": e["hash"]} for id, e in manifest["parents"].items()},
+              "children": {id: {"hash": e["hash"], "parent": e["parent"], "page": e["page"]} for id, e in manifest["children"].items()}}
+    with open(manifest_path, "w") as f:
+        json.dump(stored, f)
+
+def incremental_ingest(driver, text: str, pdf_id: str = "1709.00666", manifest_path: str = "ch03-manifest.json", model: str = "all-MiniLM-L12-v2", index_name: str = "parent",
+                       page_offsets: list[int] = None):
+    """
+    Import only the parent and child chunks whose content changed since the last run and
+    delete the ones that disappeared. Without a usable manifest the document is rebuilt.
+    """
+    sections = split_text_by_title(text)
+    new = build_manifest(pdf_id, sections, model, text, page_offsets)
+    old = load_manifest(manifest_path)
+    rebuild = old is None or old["model"] != model or old.get("version") != MANIFEST_VERSION
+    if not rebuild and old["document"] == new["document"]:
+        print("Document unchanged, nothing to import")
+        return
+    ensure_ingestion_schema(driver, ["PDF", "Parent", "Child"])
+    if rebuild:
+        # Unknown, differently keyed or differently embedded graph state: start from scratch
+        driver.execute_query("""
+        MATCH (pdf:PDF {id: $pdf_id})
+        OPTIONAL MATCH (pdf)-[:HAS_PARENT]->(p:Parent)
+        OPTIONAL MATCH (p)-[:HAS_CHILD]->(c:Child)
+        DETACH DELETE pdf, p, c
+        """, pdf_id=pdf_id)
+        old = {"parents": {}, "children": {}}
+
+    parent_upserts, parent_deletes = diff_manifests(old, new, "parents")
+    child_upserts, child_deletes = diff_manifests(old, new, "children")
+    page_updates = diff_child_pages(old, new)
+    print(f"Parents: {len(parent_upserts)} to upsert, {len(parent_deletes)} to delete. "
+          f"Children: {len(child_upserts)} to upsert, {len(child_deletes)} to delete, {len(page_updates)} moved to another page.")
+
+    embeddings = project_for_index(index_name, embed_batch([new["children"][id]["text"] for id in child_upserts], model))
+    write_in_batches(driver, import_parents_query,
+                     [{"id": id, "text": new["parents"][id]["text"]} for id in parent_upserts], pdf_id=pdf_id)
+    write_in_batches(driver, import_children_query,
+                     [{"id": id, "parent": new["children"][id]["parent"], "text": new["children"][id]["text"],
+                       "page": new["children"][id]["page"], "embedding": as_vector(embedding)}
+                      for id, embedding in zip(child_upserts, embeddings)], pdf_id=pdf_id)
+    # Page-only changes keep the text and so the embedding
+    write_in_batches(driver, """
+    UNWIND $rows AS row
+    MATCH (c:Child {pdf_id: $pdf_id, id: row.id})
+    SET c.page = row.page
+    """, [{"id": id, "page": new["children"][id]["page"]} for id in page_updates], pdf_id=pdf_id)
+    write_in_batches(driver, """
+    UNWIND $rows AS id
+    MATCH (c:Child {pdf_id: $pdf_id, id: id})
+    DETACH DELETE c
+    """, child_deletes, pdf_id=pdf_id)
+    write_in_batches(driver, """
+    UNWIND $rows AS id
+    MATCH (p:Parent {pdf_id: $pdf_id, id: id})
+    DETACH DELETE p
+    """, parent_deletes, pdf_id=pdf_id)
+    save_manifest(new, manifest_path)
+
+def create_vector_index_on_child_nodes(driver, index_name: str = "parent", model: str = "all-MiniLM-L12-v2", **options):
+    # With quantization=True, pass oversample to parent_retrieval to rescore against the full vectors
+    return ensure_vector_index(driver, index_name, "Child", model, **options)
+
+def parent_retrieval(driver, question, index_name, oversample: int = None):
+    question_embedding = project_for_index(index_name, embed_query(question, "all-MiniLM-L12-v2"))
+    if oversample:
+        # Children found by the quantized index are rescored exactly before picking their parents
+        similar_records, _, _ = catalog.run(driver, "rescored_parent_retrieval", index_name=index_name,
+                                            question_embedding=question_embedding, k=10, oversample=oversample)
+    else:
+        similar_records, _, _ = catalog.run(driver, "parent_retrieval", index_name=index_name, question_embedding=question_embedding, k=10)
     return [record["text"] for record in similar_records]
 
 def generate_answer(question: str, documents: List[str]) -> str:
@@ -152,24 +284,17 @@ def rag_pipeline(question: str):
     stepback_question = generate_stepback_question(question)
     print(f"Stepback question: {stepback_question}")
     
-    driver = neo4j_driver()
+    driver = get_driver()
+    catalog.warmup(driver)
     
-    # Clear existing data to avoid embedding dimension conflicts
-    clear_existing_data(driver)
-    drop_vector_index(driver, "parent")
-    
-    text = download_and_create_pdf(remote_pdf_url, prf_filename)
-    sections = split_text_by_title(text)
-    print(f"Number of sections: {len(sections)}")
-    parent_chunks = create_parent_chunks(sections)
-    print(f"Number of parent chunks: {len(parent_chunks)}")
-    store_parent_chunks(driver, parent_chunks)
+    # Only re-embed and write the chunks that changed since the last run
+    text, page_offsets = download_and_create_pdf(remote_pdf_url, prf_filename)
+    incremental_ingest(driver, text, page_offsets=page_offsets)
     create_vector_index_on_child_nodes(driver)
     similar_documents = parent_retrieval(driver, stepback_question, "parent")
     answer = generate_answer(question, similar_documents)
     print(answer)
     
-    driver.close()
 
 
 if __name__ == "__main__":
@@ -177,13 +302,13 @@ if __name__ == "__main__":
     stepback_question = generate_stepback_question(question)
     print(f"Stepback question: {stepback_question}")
     
-    driver = neo4j_driver()
+    driver = get_driver()
     
     # Clear existing data to avoid embedding dimension conflicts
     #clear_existing_data(driver)
     #drop_vector_index(driver, "parent")
     
-    text = download_and_create_pdf(remote_pdf_url, prf_filename)
+    text, page_offsets = download_and_create_pdf(remote_pdf_url, prf_filename)
     sections = split_text_by_title(text)
     #print(f"Number of sections: {len(sections)}")
     # for i, section in enumerate(sections):
@@ -193,7 +318,7 @@ if __name__ == "__main__":
     # for i, chunk in enumerate(parent_chunks):
     #     print(f"Parent chunk {i}: {num_tokens_from_section(chunk)} tokens")
     
-    #store_parent_chunks(driver, parent_chunks)
+    #store_parent_chunks(driver, parent_chunks, text=text, page_offsets=page_offsets)
     #create_vector_index_on_child_nodes(driver)
     similar_documents = parent_retrieval(driver, stepback_question, "parent")
     for i, doc in enumerate(similar_documents):
@@ -203,6 +328,4 @@ if __name__ == "__main__":
     answer = generate_answer(question, similar_documents)
     print(answer)
     
-    # Close the driver properly at the end
-    driver.close()
 
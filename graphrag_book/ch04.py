@@ -1,5 +1,5 @@
 from cypher_queries import movie_query
-from utils import neo4j_driver
+from utils import get_driver
 from schema_utils import get_schema, chat
 
 from dotenv import load_dotenv
@@ -68,7 +68,7 @@ def create_full_prompt(driver, question):
         return full_prompt
 
 if __name__ == "__main__":
-    driver = neo4j_driver()
+    driver = get_driver()
     #create_movie_database(driver)
     #print_schema(driver)
     full_prompt = create_full_prompt(driver, "Who directed the most movies?")
@@ -81,4 +81,3 @@ if __name__ == "__main__":
         ],
     )
     print(response)
-    driver.close()
@@ -2,7 +2,7 @@ import os
 import dotenv
 import json
 import ch05_tools
-from utils import chat, tool_choice, neo4j_driver
+from utils import chat, tool_choice, get_driver
 from ch04 import create_movie_database
 from dotenv import load_dotenv
 load_dotenv()
@@ -150,8 +150,7 @@ def agentic_rag(input: str):
     return llm_response
 
 if __name__ == "__main__":
-    driver = neo4j_driver()
+    driver = get_driver()
     #create_movie_database(driver)
     response = agentic_rag("Who's the main actor in the movie Matrix and what other movies is that person in?")
-    print(response)
-    driver.close()
\ No newline at end of file
+    print(response)
\ No newline at end of file
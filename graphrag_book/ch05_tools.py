@@ -1,4 +1,4 @@
-from utils import neo4j_driver
+from utils import get_driver
 from text2cypher import Text2Cypher
 
 text2cypher_description = {
@@ -19,13 +19,12 @@ text2cypher_description = {
 }
 
 def text2cypher(question: str):
-    driver = neo4j_driver()
+    driver = get_driver()
     t2c = Text2Cypher(driver)
     t2c.set_prompt_section("question", question)
     cypher = t2c.generate_cypher()
     records, _, _ = driver.execute_query(cypher)
     result = [record.data() for record in records]
-    driver.close()
     return result
 
 movie_info_by_title_description = {
@@ -53,10 +52,9 @@ def movie_info_by_title(title: str):
  OPTIONAL MATCH (m)<-[:DIRECTED]-(d:Person)
  RETURN m AS movie, collect(a.name) AS cast, collect(d.name) AS directors
  """
-    driver = neo4j_driver()
+    driver = get_driver()
     records, _, _ = driver.execute_query(cypher, title=title.lower())
     result = [record.data() for record in records]
-    driver.close()
     return result
 
 movies_info_by_actor_description = {
@@ -84,10 +82,9 @@ def movies_info_by_actor(actor: str):
     WHERE toLower(a.name) CONTAINS $actor
     RETURN m AS movie, collect(a.name) AS cast, collect(d.name) AS directors
  """
-    driver = neo4j_driver()
+    driver = get_driver()
     records, _, _ = driver.execute_query(cypher, actor=actor.lower())
     result = [record.data() for record in records]
-    driver.close()
     return result
 
 answer_given_description = {
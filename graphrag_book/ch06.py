@@ -3,7 +3,8 @@ from pydantic import BaseModel, Field
 from typing import Optional, List
 from openai import OpenAI
 import json
-from utils import neo4j_driver
+from utils import get_driver
+from write_executor import WriteExecutor
 import os
 
 contract_types = [
@@ -108,8 +109,7 @@ def create_knowledge_graph(driver):
                          CREATE CONSTRAINT IF NOT EXISTS FOR (l:Location) REQUIRE l.fullAddress IS UNIQUE;
                          """)
     
-def import_to_knowledge_graph(driver, document):
-    import_query = """WITH $data AS contract_data
+import_query = """WITH $data AS contract_data
 // Create Contract node
 MERGE (contract:Contract {id: randomUUID()})
 SET contract += {
@@ -143,7 +143,16 @@ MERGE (p)-[:LOCATED_AT]->(loc)
 MERGE (p)-[r:HAS_PARTY]->(contract)
 SET r.role = party.role
 """
+
+def import_to_knowledge_graph(driver, document):
     driver.execute_query(import_query, data=extract(document))
+
+def import_documents_to_knowledge_graph(driver, documents, workers=4):
+    # Extraction (LLM calls) runs here while up to `workers` sessions import the previous contracts;
+    # submit blocks when the writers fall behind
+    with WriteExecutor(driver, workers) as executor:
+        for document in documents:
+            executor.submit_query(import_query, data=extract(document))
     
 def query_knowledge_graph(driver, query):
     cypher = """
@@ -160,7 +169,7 @@ if __name__ == "__main__":
     with open("data/license_agreement.txt", "r") as f:
         document = f.read()
     #print(extract(document))
-    driver = neo4j_driver()
+    driver = get_driver()
     create_knowledge_graph(driver)
     import_to_knowledge_graph(driver, document)
     print(query_knowledge_graph(driver, "Licensing Agreement"))
@@ -1,14 +1,26 @@
-from utils import neo4j_driver, chat, chunk_text, embed, num_tokens_from_string
+from utils import as_vector, content_hash, get_driver, chat, write_in_batches, chunk_text, embed_batch, embed_query, num_tokens_from_strings, preprocess_documents
 from dotenv import load_dotenv
 import os
-import requests
+from source_store import get_source_store
+from pipeline import PipelineRunner, StageCheckpoint
+from write_executor import WriteExecutor, PartitionedWriter
+from functools import partial
+from graph_schema import ensure_ingestion_schema
+from query_catalog import catalog
+from vector_index import ensure_vector_index
+from projection import project_for_index
 from ch07_tools import (create_extraction_prompt, 
                         parse_extraction_output, 
                         import_nodes_query, 
                         import_relationships_query, 
+                        import_chunk_rows_query,
+                        import_mention_rows_query,
+                        import_relationship_rows_query,
                         get_summarize_prompt, 
                         import_entity_summary, 
                         import_rels_summary, 
+                        import_single_entity_summaries,
+                        import_single_rels_summaries,
                         calculate_communities,
                         community_info_query,
                         get_summarize_community_prompt,
@@ -26,8 +38,7 @@ import json
 load_dotenv(override=True)
 
 def load_data_and_chunk_into_books(file_path: str = "https://www.gutenberg.org/cache/epub/1727/pg1727.txt") -> list[str]:
-    response = requests.get(file_path)
-    text = ((response.text)
+    text = ((get_source_store().read_text(file_path))
     .split("PREFACE TO FIRST EDITION")[2]
     .split("FOOTNOTES")[0]
     .strip()
@@ -35,7 +46,7 @@ def load_data_and_chunk_into_books(file_path: str = "https://www.gutenberg.org/c
     return text
 
 def token_count(books: list[str]) -> int:
-    token_count = [num_tokens_from_string(book) for book in books]
+    token_count = num_tokens_from_strings(books)
     print(
         f"""There are {len(token_count)} books in the corpus, with a total of {sum(token_count)} tokens and an average of {sum(token_count) / len(token_count)} tokens per book."""
     )
@@ -46,6 +57,15 @@ def chunk_books(books: list[str]) -> List[str]:
     chunked_books = [chunk_text(book, chunk_size, overlap) for book in books]
     return chunked_books
 
+def preprocess_books(books: list[str], workers: int = None) -> List[List[str]]:
+    """Chunk and count tokens of all books in parallel and report per-book stats."""
+    results = preprocess_documents(books, chunk_size=1000, overlap=40, workers=workers)
+    for i, result in enumerate(results):
+        print(f"Book {i}: {result['num_tokens']} tokens, {result['num_chars']} characters, {result['num_chunks']} chunks")
+    total_tokens = sum(result["num_tokens"] for result in results)
+    print(f"There are {len(results)} books in the corpus, with a total of {total_tokens} tokens and an average of {total_tokens / len(results)} tokens per book.")
+    return [result["chunks"] for result in results]
+
 ENTITY_TYPES = ["PERSON", 
                 "ORGANIZATION", 
                 "LOCATION", 
@@ -62,26 +82,109 @@ def extract_entities_and_relationships(text: str) -> List[str]:
     response = chat(messages, model="gpt-4o-mini")
     return parse_extraction_output(response)
 
-def store_to_neo4j(driver, chunked_books: List[List[str]]):
+def _import_chunk(tx, entities, relationships, book_id, chunk_id, text):
+    tx.run(import_nodes_query, data=entities, book_id=book_id, chunk_id=chunk_id, text=text).consume()
+    tx.run(import_relationships_query, data=relationships).consume()
+
+def _mark_when_written(future, checkpoint: StageCheckpoint, key: str):
+    if future.exception() is None:
+        checkpoint.mark(key)
+
+def store_to_neo4j(driver, chunked_books: List[List[str]], checkpoint: StageCheckpoint = None, workers: int = 1):
+    number_of_books = 1
+    ensure_ingestion_schema(driver, ["Book", "__Chunk__", "__Entity__"])
+    # Extraction runs here while `workers` sessions import the extracted chunks; submit blocks when they fall behind
+    with WriteExecutor(driver, workers) as executor:
+        for book_i, book in enumerate(
+            tqdm(chunked_books[:number_of_books], desc="Processing books")
+        ):
+            for chunk_i, chunk in enumerate(
+                tqdm(book, desc="Processing chunks")
+            ):
+                if checkpoint and checkpoint.done(f"{book_i}-{chunk_i}"):
+                    continue
+                entities, relationships = extract_entities_and_relationships(chunk)
+                # Nodes and relationships of a chunk are written in one transaction, so a
+                # crash never leaves a half-imported chunk behind to be duplicated on resume
+                future = executor.submit(_import_chunk, entities, relationships, book_i, chunk_i, chunk)
+                if checkpoint:
+                    future.add_done_callback(partial(_mark_when_written, checkpoint=checkpoint, key=f"{book_i}-{chunk_i}"))
+
+def _mention_rows(entities: list[dict], book_id: int, chunk_id: int) -> list[dict]:
+    """One mention row per entity of a chunk, with every type and description the chunk gives it."""
+    rows = {}
+    for entity in entities:
+        row = rows.setdefault(entity["entity_name"], {"entity_name": entity["entity_name"], "entity_types": [],
+                                                      "entity_descriptions": [], "book_id": book_id, "chunk_id": chunk_id})
+        if entity["entity_type"] not in row["entity_types"]:
+            row["entity_types"].append(entity["entity_type"])
+        row["entity_descriptions"].append(entity["entity_description"])
+    return list(rows.values())
+
+def _relationship_rows(relationships: list[dict], book_id: int, chunk_id: int) -> list[dict]:
+    """Relationship rows keyed by the hash of their content; repeated identical rows get an ordinal, as CREATE kept each one."""
+    rows, seen = [], {}
+    for relationship in relationships:
+        content = content_hash(json.dumps([relationship["source_entity"], relationship["target_entity"],
+                                           relationship["relationship_description"], relationship["relationship_strength"]]))
+        seen[content] = seen.get(content, 0) + 1
+        rows.append(dict(relationship, book_id=book_id, chunk_id=chunk_id, key=f"{content}-{seen[content]}"))
+    return rows
+
+def _relationship_lock_order(row: dict) -> tuple:
+    return tuple(sorted((row["source_entity"], row["target_entity"])))
+
+def _write_window(driver, chunk_writer, mention_writer, chunks, mentions, relationships):
+    # Mentions MATCH their chunk and relationships should see labelled entities, so each step waits for the previous one
+    chunk_writer.add(chunks)
+    chunk_writer.flush()
+    mention_writer.add(mentions)
+    mention_writer.flush()
+    # A relationship locks two entities that live in different partitions, so these are written
+    # by a single session, in endpoint order, rather than partitioned
+    write_in_batches(driver, import_relationship_rows_query, sorted(relationships, key=_relationship_lock_order))
+
+def store_to_neo4j_partitioned(driver, chunked_books: List[List[str]], checkpoint: StageCheckpoint = None,
+                               workers: int = 4, window: int = 20, batch_size: int = 200):
+    """
+    Parallel variant of store_to_neo4j. Extracted rows are written every `window` chunks.
+    Mentions are partitioned on the entity name, so popular entities (ODYSSEUS, JOVE) are
+    always merged by a single worker, and sorted by chunk, so the chunks they share are
+    locked in the same order by every worker. Chunks are checkpointed once all of their
+    window has been written; all writes are idempotent, so a window interrupted by a crash
+    is simply written again on resume.
+    """
     number_of_books = 1
-    for book_i, book in enumerate(
-        tqdm(chunked_books[:number_of_books], desc="Processing books")
-    ):
-        for chunk_i, chunk in enumerate(
-            tqdm(book, desc="Processing chunks")
+    ensure_ingestion_schema(driver, ["Book", "__Chunk__", "__Entity__"])
+    with PartitionedWriter(driver, import_chunk_rows_query, key=lambda row: row["book_id"], workers=workers, batch_size=batch_size) as chunk_writer, \
+         PartitionedWriter(driver, import_mention_rows_query, key=lambda row: row["entity_name"], workers=workers, batch_size=batch_size,
+                           order=lambda row: (row["book_id"], row["chunk_id"], row["entity_name"])) as mention_writer:
+        chunks, mentions, relationships, keys = [], [], [], []
+        for book_i, book in enumerate(
+            tqdm(chunked_books[:number_of_books], desc="Processing books")
         ):
-            entities, relationships = extract_entities_and_relationships(chunk)
-            driver.execute_query(import_nodes_query, 
-                                 data=entities,
-                                 book_id=book_i,
-                                 chunk_id=chunk_i,
-                                 text=chunk)
-            
-            driver.execute_query(
-                import_relationships_query,
-                data=relationships,
-                )
-            
+            for chunk_i, chunk in enumerate(
+                tqdm(book, desc="Processing chunks")
+            ):
+                if checkpoint and checkpoint.done(f"{book_i}-{chunk_i}"):
+                    continue
+                chunk_entities, chunk_relationships = extract_entities_and_relationships(chunk)
+                chunks.append({"book_id": book_i, "chunk_id": chunk_i, "text": chunk})
+                mentions.extend(_mention_rows(chunk_entities, book_i, chunk_i))
+                relationships.extend(_relationship_rows(chunk_relationships, book_i, chunk_i))
+                keys.append(f"{book_i}-{chunk_i}")
+                if len(keys) >= window:
+                    _write_window(driver, chunk_writer, mention_writer, chunks, mentions, relationships)
+                    if checkpoint:
+                        for key in keys:
+                            checkpoint.mark(key)
+                    chunks, mentions, relationships, keys = [], [], [], []
+        if keys:
+            _write_window(driver, chunk_writer, mention_writer, chunks, mentions, relationships)
+            if checkpoint:
+                for key in keys:
+                    checkpoint.mark(key)
+
 def query_database(driver: neo4j.Driver):
     data, _, _ =driver.execute_query("""
                          MATCH (:`__Entity__`)
@@ -110,19 +213,28 @@ def query_relationship_description(driver: neo4j.Driver):
                                       """)
     print([el.data() for el in data])
     
-def summarize_candidate_entities(driver: neo4j.Driver):
+def summarize_candidate_entities(driver: neo4j.Driver, checkpoint: StageCheckpoint = None):
+    """With a checkpoint, each summary is imported as soon as it is generated and already summarized entities are skipped."""
     candidate_to_summarize, _, _ = driver.execute_query("""
                                                         MATCH (e:__Entity__) WHERE size(e.description) > 1
                                                         RETURN e.name AS entity_name, e.description AS description_list
                                                         """)
     summaries = []
     for en in tqdm(candidate_to_summarize, desc="Summarizing entities"):
+        if checkpoint and checkpoint.done(en["entity_name"]):
+            continue
         messages = [
             #{"role": "system", "content": "You are a helpful assistant that summarizes the description of an entity."},
             {"role": "user", "content": get_summarize_prompt(en["entity_name"], en["description_list"])}
         ]
         response = chat(messages, model="gpt-4o-mini")
         summaries.append({"entity_name": en["entity_name"], "summary": response})
+        if checkpoint:
+            import_entity_summary(driver, summaries[-1:], fill_single=False)
+            checkpoint.mark(en["entity_name"])
+    if checkpoint:
+        # Scans the whole graph, so it runs once per stage rather than once per summary
+        import_single_entity_summaries(driver)
     return summaries
 
 def import_summaries_to_neo4j(driver: neo4j.Driver, summaries: List[dict]):
@@ -136,7 +248,8 @@ def query_summaries(driver: neo4j.Driver):
                                       """)
     print([el.data() for el in data])   
 
-def summarize_candidate_relationships(driver: neo4j.Driver):
+def summarize_candidate_relationships(driver: neo4j.Driver, checkpoint: StageCheckpoint = None):
+    """With a checkpoint, each summary is imported as soon as it is generated and already summarized pairs are skipped."""
     candidate_to_summarize, _, _ = driver.execute_query("""
                                                         MATCH (s:__Entity__)-[r:RELATIONSHIP]-(t:__Entity__)
                                                         WHERE id(s) < id(t)
@@ -147,12 +260,20 @@ def summarize_candidate_relationships(driver: neo4j.Driver):
     summaries = []
     for rel in tqdm(candidate_to_summarize, desc="Summarizing relationships"):
         entity_name = f"{rel['source']} relationship to {rel['target']}"
+        if checkpoint and checkpoint.done(entity_name):
+            continue
         messages = [
             #{"role": "system", "content": "You are a helpful assistant that summarizes the description of a relationship."},
             {"role": "user", "content": get_summarize_prompt(entity_name, rel["description_list"])}
         ]
         response = chat(messages, model="gpt-4o-mini")
         summaries.append({"source": rel["source"], "target": rel["target"], "summary": response})
+        if checkpoint:
+            import_rels_summary(driver, summaries[-1:], fill_single=False)
+            checkpoint.mark(entity_name)
+    if checkpoint:
+        # Only after all pairs are summarized, otherwise it would also fill in pairs still waiting for a summary
+        import_single_rels_summaries(driver)
     return summaries
 
 def import_relationship_summaries_to_neo4j(driver: neo4j.Driver, summaries: List[dict]):
@@ -170,10 +291,12 @@ def community_detection(driver: neo4j.Driver):
     print(f"""There are {community_distribution['communityCount']} communities in the graph with distribution:
           {community_distribution['communityDistribution']}""")
 
-def community_summary(driver: neo4j.Driver):
+def community_summary(driver: neo4j.Driver, checkpoint: StageCheckpoint = None):
     community_info, _, _ = driver.execute_query(community_info_query)
     community_summaries = []
     for community in tqdm(community_info, desc="Summarizing communities"):
+        if checkpoint and checkpoint.done(community["communityId"]):
+            continue
         messages = [
             {"role": "user", "content": get_summarize_community_prompt(community["nodes"], community["rels"])}
         ]
@@ -183,7 +306,11 @@ def community_summary(driver: neo4j.Driver):
             "communityId": community["communityId"],
             "nodes": [el["id"] for el in community["nodes"]],
         })
-    driver.execute_query(import_community_query, data=community_summaries)
+        if checkpoint:
+            driver.execute_query(import_community_query, data=community_summaries[-1:])
+            checkpoint.mark(community["communityId"])
+    if not checkpoint:
+        driver.execute_query(import_community_query, data=community_summaries)
 
 def retrieve_community_extract(driver: neo4j.Driver):
     data, _, _ = driver.execute_query("""
@@ -218,7 +345,7 @@ def global_retriever(driver: neo4j.Driver, query: str, rating_threshold: float =
     final_response = chat(final_messages, model="gpt-4o")
     return final_response
 
-def generate_embedding_for_entities(driver: neo4j.Driver):
+def generate_embedding_for_entities(driver: neo4j.Driver, **index_options):
     
     entities, _, _ = driver.execute_query("""
                                           MATCH (e:__Entity__)
@@ -227,7 +354,8 @@ def generate_embedding_for_entities(driver: neo4j.Driver):
                                           """
                                           )
     
-    data = [{"name": el["name"], "embedding": embed(el["summary"], model="all-MiniLM-L12-v2")[0]} for el in entities]
+    embeddings = project_for_index("entities", embed_batch([el["summary"] for el in entities], model="all-MiniLM-L12-v2"))
+    data = [{"name": el["name"], "embedding": as_vector(embedding)} for el, embedding in zip(entities, embeddings)]
     
     driver.execute_query("""
                          UNWIND $data AS row
@@ -237,58 +365,17 @@ def generate_embedding_for_entities(driver: neo4j.Driver):
                          data=data,
                          )
     
-    driver.execute_query("""
-                         CREATE VECTOR INDEX entities IF NOT EXISTS
-                         FOR (n:__Entity__)
-                         ON (n.embedding)
-                         """,
-                         data=data,
-                         )
+    # index_options are the HNSW/quantization settings of the entities index
+    ensure_vector_index(driver, "entities", "__Entity__", "all-MiniLM-L12-v2", **index_options)
 
 def local_search(driver: neo4j.Driver, query: str, k: int = 5, top_chunks: int = 3, top_communities: int = 3, top_inside_rels: int = 3) -> str:
-    local_search_query = """
-CALL db.index.vector.queryNodes('entities', $k, $embedding)
-YIELD node, score
-WITH collect(node) as nodes
-WITH collect {
-    UNWIND nodes as n
-    MATCH (n)<-[:HAS_ENTITY]->(c:__Chunk__)
-    WITH c, count(distinct n) as freq
-    RETURN c.text AS chunkText
-    ORDER BY freq DESC
-    LIMIT $topChunks
-} AS text_mapping,
-collect {
-    UNWIND nodes as n
-    MATCH (n)-[:IN_COMMUNITY]->(c:__Community__)
-    WITH c, c.rank as rank, c.weight AS weight
-    RETURN c.summary 
-    ORDER BY rank, weight DESC
-    LIMIT $topCommunities
-} AS report_mapping,
-collect {
-    UNWIND nodes as n
-    MATCH (n)-[r:SUMMARIZED_RELATIONSHIP]-(m) 
-    WHERE m IN nodes
-    RETURN r.summary AS descriptionText
-    ORDER BY r.rank, r.weight DESC 
-    LIMIT $topInsideRels
-} as insideRels,
-collect {
-    UNWIND nodes as n
-    RETURN n.summary AS descriptionText
-} as entities
-RETURN {Chunks: text_mapping, Reports: report_mapping, 
-       Relationships: insideRels, 
-       Entities: entities} AS text
-"""
-    context, _, _ = driver.execute_query(local_search_query,
-                                         k=k,
-                                         topChunks=top_chunks,
-                                         topCommunities=top_communities,
-                                         topInsideRels=top_inside_rels,
-                                         embedding=embed(query, model="all-MiniLM-L12-v2")[0]
-                                         )
+    context, _, _ = catalog.run(driver, "local_search",
+                                k=k,
+                                topChunks=top_chunks,
+                                topCommunities=top_communities,
+                                topInsideRels=top_inside_rels,
+                                embedding=project_for_index("entities", embed_query(query, model="all-MiniLM-L12-v2"))
+                                )
     context_str = str(context[0]["text"])
     messages = [
         {"role": "system", "content": get_local_system_prompt(context_str)},
@@ -297,14 +384,33 @@ RETURN {Chunks: text_mapping, Reports: report_mapping,
     response = chat(messages, model="gpt-4o")
     return context_str, response
     
+def run_indexing_pipeline(driver: neo4j.Driver, chunked_books: List[List[str]], manifest_path: str = "ch07-manifest.json", stages: List[str] = None, write_workers: int = 1):
+    """
+    Run the GraphRAG indexing steps as named, resumable stages. Progress is kept in
+    manifest_path, so re-running after a failure only redoes the unfinished work.
+    With write_workers > 1 extraction results are imported by partitioned writers.
+    """
+    runner = PipelineRunner(manifest_path)
+    if write_workers > 1:
+        runner.add_stage("extract", lambda checkpoint: store_to_neo4j_partitioned(driver, chunked_books, checkpoint, write_workers))
+    else:
+        runner.add_stage("extract", lambda checkpoint: store_to_neo4j(driver, chunked_books, checkpoint))
+    runner.add_stage("entity_summaries", lambda checkpoint: summarize_candidate_entities(driver, checkpoint))
+    runner.add_stage("relationship_summaries", lambda checkpoint: summarize_candidate_relationships(driver, checkpoint))
+    runner.add_stage("communities", lambda checkpoint: community_detection(driver))
+    runner.add_stage("community_summaries", lambda checkpoint: community_summary(driver, checkpoint))
+    runner.add_stage("entity_embeddings", lambda checkpoint: generate_embedding_for_entities(driver))
+    runner.run(stages)
+
 if __name__ == "__main__":
     books = load_data_and_chunk_into_books()
-    token_count(books)
-    chunked_books = chunk_books(books)
+    chunked_books = preprocess_books(books)
     #print(chunked_books[0][0])
     #embeddings = create_embeddings(chunks)
-    driver = neo4j_driver()
+    driver = get_driver()
+    catalog.warmup(driver)
     #driver.execute_query("""MATCH(n) DETACH DELETE(n)""")
+    #run_indexing_pipeline(driver, chunked_books)
     #store_to_neo4j(driver, chunked_books)
     #query_database(driver)
     #query_person_description(driver)
@@ -325,5 +431,4 @@ if __name__ == "__main__":
     print(context)
     print("-"*100)
     print(response)
-    driver.close()
             
\ No newline at end of file
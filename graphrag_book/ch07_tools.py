@@ -257,8 +257,9 @@ def parse_extraction_output(output_str, record_delimiter=None, tuple_delimiter=N
 
 import_nodes_query = """
 MERGE (b:Book {id: $book_id})
-MERGE (b)-[:HAS_CHUNK]->(c:__Chunk__ {id: $chunk_id})
+MERGE (c:__Chunk__ {book_id: $book_id, id: $chunk_id})
 SET c.text = $text
+MERGE (b)-[:HAS_CHUNK]->(c)
 WITH c
 UNWIND $data AS row
 MERGE (n:__Entity__ {name: row.entity_name})
@@ -274,6 +275,37 @@ MERGE (t:__Entity__ {name: row.target_entity})
 CREATE (s)-[r:RELATIONSHIP {description: row.relationship_description, strength: row.relationship_strength}]->(t)
 """
 
+# Row-wise variants of the queries above for the partitioned import: chunks are written
+# first, then entity mentions partitioned by entity name, then relationships. They build
+# the same graph as the queries above but are idempotent, so a window that was partly
+# written before a crash can be written again on resume without duplicating descriptions
+# or relationships. A mention row carries all the descriptions one chunk gives an entity
+# and is applied once per (entity, chunk); a relationship row is keyed by its content.
+import_chunk_rows_query = """
+UNWIND $rows AS row
+MERGE (b:Book {id: row.book_id})
+MERGE (c:__Chunk__ {book_id: row.book_id, id: row.chunk_id})
+SET c.text = row.text
+MERGE (b)-[:HAS_CHUNK]->(c)
+"""
+
+import_mention_rows_query = """
+UNWIND $rows AS row
+MATCH (c:__Chunk__ {book_id: row.book_id, id: row.chunk_id})
+MERGE (n:__Entity__ {name: row.entity_name})
+SET n:$(row.entity_types)
+MERGE (n)<-[:MENTIONS]-(c)
+ON CREATE SET n.description = coalesce(n.description, []) + row.entity_descriptions
+"""
+
+import_relationship_rows_query = """
+UNWIND $rows AS row
+MERGE (s:__Entity__ {name: row.source_entity})
+MERGE (t:__Entity__ {name: row.target_entity})
+MERGE (s)-[r:RELATIONSHIP {book_id: row.book_id, chunk_id: row.chunk_id, key: row.key}]->(t)
+ON CREATE SET r.description = row.relationship_description, r.strength = row.relationship_strength
+"""
+
 SUMMARIZE_PROMPT = """
 You are a helpful assistant responsible for generating a comprehensive summary of the data provided below.
 Given one or two entities, and a list of descriptions, all related to the same entity or group of entities.
@@ -490,13 +522,17 @@ MERGE (n:__Entity__ {name: node})
 MERGE (n)-[:IN_COMMUNITY]->(c)
 """
 
-def import_entity_summary(neo4j_driver, entity_information):
+def import_entity_summary(neo4j_driver, entity_information, fill_single: bool = True):
+    """With fill_single=False only the given summaries are written; call import_single_entity_summaries once afterwards."""
     neo4j_driver.execute_query("""
     UNWIND $data AS row
-    MATCH (e:__Entity__ {name: row.entity})
+    MATCH (e:__Entity__ {name: row.entity_name})
     SET e.summary = row.summary
     """, data=entity_information)
-    
+    if fill_single:
+        import_single_entity_summaries(neo4j_driver)
+
+def import_single_entity_summaries(neo4j_driver):
     # If there was only 1 description use that
     neo4j_driver.execute_query("""
     MATCH (e:__Entity__)
@@ -504,14 +540,18 @@ def import_entity_summary(neo4j_driver, entity_information):
     SET e.summary = e.description[0]
     """)
 
-def import_rels_summary(neo4j_driver, rel_summaries):
+def import_rels_summary(neo4j_driver, rel_summaries, fill_single: bool = True):
+    """With fill_single=False only the given summaries are written; call import_single_rels_summaries once afterwards."""
     neo4j_driver.execute_query("""
     UNWIND $data AS row
     MATCH (s:__Entity__ {name: row.source}), (t:__Entity__ {name: row.target})
     MERGE (s)-[r:SUMMARIZED_RELATIONSHIP]-(t)
     SET r.summary = row.summary
     """, data=rel_summaries)
-    
+    if fill_single:
+        import_single_rels_summaries(neo4j_driver)
+
+def import_single_rels_summaries(neo4j_driver):
     # If there was only 1 description use that
     neo4j_driver.execute_query("""
     MATCH (s:__Entity__)-[e:RELATIONSHIP]-(t:__Entity__)
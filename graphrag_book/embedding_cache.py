@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+KEY_SIZE = 16
+EMPTY_KEY = bytes(KEY_SIZE)
+INITIAL_CAPACITY = 1024
+# One record of the key log: the slot a key was written to (EMPTY_KEY when the slot was freed)
+LOG_RECORD = np.dtype([("slot", "<i8"), ("key", f"V{KEY_SIZE}")])
+
+
+def text_key(text: str) -> bytes:
+    """Content address of a text: a 16-byte BLAKE2b digest of its UTF-8 bytes."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=KEY_SIZE).digest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings for a single model, keyed by the hash of the text.
+
+    Vectors live in a memory-mapped float32 file (one row per slot). The keys and
+    last-access ticks are snapshotted in small .npy files by flush(); in between,
+    each put only appends its (slot, key) records to a key log, which is replayed on
+    load and folded into the snapshot once it outgrows it. When max_entries is set,
+    the least recently used entries are evicted and their slots reused.
+    """
+
+    def __init__(self, directory: str, model: str, max_entries: Optional[int] = None):
+        self.directory = directory
+        self.model = model
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, model.replace("/", "_"))
+        self._meta_path = base + ".meta.json"
+        self._vectors_path = base + ".vectors.f32"
+        self._keys_path = base + ".keys.npy"
+        self._ticks_path = base + ".ticks.npy"
+        self._log_path = base + ".keys.log"
+
+        self.dimensions = None
+        self._capacity = 0
+        self._vectors = None
+        self._keys = np.zeros(0, dtype=f"V{KEY_SIZE}")
+        self._ticks = np.zeros(0, dtype=np.int64)
+        self._slots = {}
+        self._tick = 0
+        self._log_records = 0
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self._meta_path):
+            self._load()
+
+    def _load(self):
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        self.dimensions = meta["dimensions"]
+        self._capacity = meta["capacity"]
+        if os.path.exists(self._keys_path):
+            self._keys = np.load(self._keys_path)
+            self._ticks = np.load(self._ticks_path)
+        self._tick = int(self._ticks.max()) if len(self._ticks) else 0
+        if os.path.exists(self._log_path):
+            records = np.fromfile(self._log_path, dtype=LOG_RECORD)
+            self._log_records = len(records)
+            if len(records):
+                size = max(len(self._keys), int(records["slot"].max()) + 1)
+                self._resize_index(size)
+                # Later records win; entries written since the last flush count as recently used
+                self._keys[records["slot"]] = records["key"]
+                self._ticks[records["slot"]] = self._tick
+        if self._capacity:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                      shape=(self._capacity, self.dimensions))
+        self._slots = {key: slot for slot, key in enumerate(self._keys.tolist()) if key != EMPTY_KEY}
+        if self.max_entries is not None and len(self._keys) > self.max_entries:
+            # Reopened with a lower limit: slots past it cannot be kept, so shrink the files
+            self._compact(self.max_entries)
+
+    def _resize_index(self, size: int):
+        grow = size - len(self._keys)
+        self._keys = np.concatenate([self._keys, np.zeros(grow, dtype=self._keys.dtype)])
+        self._ticks = np.concatenate([self._ticks, np.full(grow, -1, dtype=np.int64)])
+
+    def _write_meta(self):
+        with open(self._meta_path, "w") as f:
+            json.dump({"model": self.model, "dimensions": self.dimensions, "capacity": self._capacity}, f)
+
+    def _save_index(self):
+        """Snapshot keys and ticks and empty the key log they now include."""
+        if self._vectors is not None:
+            self._vectors.flush()
+        np.save(self._keys_path, self._keys)
+        np.save(self._ticks_path, self._ticks)
+        self._write_meta()
+        open(self._log_path, "wb").close()
+        self._log_records = 0
+        self._dirty = False
+
+    def _compact(self, max_entries: int):
+        """Keep the max_entries most recently used entries, moved to the first slots, and shrink the files to them."""
+        live = np.flatnonzero(self._keys != np.array(EMPTY_KEY, dtype=self._keys.dtype))
+        if len(live) > max_entries:
+            live = live[np.argsort(self._ticks[live])[len(live) - max_entries:]]
+        live.sort()
+        vectors = np.array(self._vectors[live]) if len(live) else np.zeros((0, self.dimensions), dtype=np.float32)
+        self._keys = self._keys[live]
+        self._ticks = self._ticks[live]
+        self._slots = {key: slot for slot, key in enumerate(self._keys.tolist())}
+        if self._vectors is not None:
+            del self._vectors
+            self._vectors = None
+        tmp_path = self._vectors_path + ".tmp"
+        vectors.tofile(tmp_path)
+        os.replace(tmp_path, self._vectors_path)
+        self._capacity = len(live)
+        if self._capacity:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                      shape=(self._capacity, self.dimensions))
+        self._save_index()
+
+    def _grow(self, needed: int):
+        capacity = max(self._capacity, INITIAL_CAPACITY)
+        while capacity < needed:
+            capacity *= 2
+        if self.max_entries is not None:
+            capacity = min(capacity, self.max_entries)
+        # Slots already handed out stay addressable; only _compact may shrink the file
+        capacity = max(capacity, self._capacity, len(self._keys))
+        if capacity == self._capacity:
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(capacity * self.dimensions * 4)
+        self._capacity = capacity
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                  shape=(capacity, self.dimensions))
+        self._write_meta()
+
+    def _evict(self, count: int) -> list[int]:
+        """Free the count least recently used slots and return them."""
+        count = min(count, len(self._ticks))
+        slots = np.argpartition(self._ticks, count - 1)[:count].tolist()
+        for slot in slots:
+            self._slots.pop(self._keys[slot].tobytes(), None)
+        return slots
+
+    def get_many(self, texts: list[str]) -> list[Optional[np.ndarray]]:
+        """Return the cached vector for each text, or None where it is missing."""
+        with self._lock:
+            results = []
+            for text in texts:
+                slot = self._slots.get(text_key(text))
+                if slot is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.hits += 1
+                self._tick += 1
+                self._ticks[slot] = self._tick
+                self._dirty = True
+                results.append(np.array(self._vectors[slot]))
+            return results
+
+    def put_many(self, texts: list[str], vectors: list) -> None:
+        with self._lock:
+            pending = {}
+            for text, vector in zip(texts, vectors):
+                key = text_key(text)
+                if key not in self._slots:
+                    pending[key] = np.asarray(vector, dtype=np.float32)
+            if not pending:
+                return
+            if self.dimensions is None:
+                self.dimensions = len(next(iter(pending.values())))
+            if self.max_entries is not None and len(pending) > self.max_entries:
+                pending = dict(list(pending.items())[-self.max_entries:])
+
+            free_slots = []
+            size = len(self._keys)
+            self._grow(size + len(pending))
+            new_slots = min(len(pending), self._capacity - size)
+            if new_slots < len(pending):
+                # Evict in larger chunks so the argpartition is amortized over many puts.
+                evict_count = max(len(pending) - new_slots, self._capacity // 10)
+                free_slots = self._evict(evict_count)
+            self._resize_index(size + new_slots)
+            free_slots = list(range(size, size + new_slots)) + free_slots
+
+            for (key, vector), slot in zip(pending.items(), free_slots):
+                self._tick += 1
+                self._vectors[slot] = vector
+                self._keys[slot] = key
+                self._ticks[slot] = self._tick
+                self._slots[key] = slot
+            # Slots freed by eviction but not refilled must not keep their old keys.
+            for slot in free_slots[len(pending):]:
+                self._keys[slot] = EMPTY_KEY
+                self._ticks[slot] = -1
+            self._append_log(free_slots)
+
+    def _append_log(self, slots: list[int]):
+        # Vectors reach the file before the log records that point at them
+        self._vectors.flush()
+        records = np.empty(len(slots), dtype=LOG_RECORD)
+        records["slot"] = slots
+        records["key"] = self._keys[slots]
+        with open(self._log_path, "ab") as f:
+            f.write(records.tobytes())
+        self._log_records += len(slots)
+        self._dirty = True
+        # Fold the log into the snapshot once it is larger, so puts stay amortized O(batch)
+        if self._log_records > max(len(self._keys), INITIAL_CAPACITY):
+            self._save_index()
+
+    def flush(self) -> None:
+        """Persist the access ticks and fold the key log into the snapshot."""
+        with self._lock:
+            if self._vectors is not None and self._dirty:
+                self._save_index()
+
+    def __len__(self) -> int:
+        return len(self._slots)
@@ -0,0 +1,71 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+_worker_model = None
+
+
+def _init_worker(model_name: str, threads_per_worker: int):
+    global _worker_model
+    # Each process gets a slice of the cores instead of every process fighting for all of them.
+    try:
+        import torch
+        torch.set_num_threads(threads_per_worker)
+    except ImportError:
+        pass
+    from utils import get_embedding_model
+    _worker_model = get_embedding_model(model_name)
+
+
+def _encode_shard(texts: list[str]) -> list:
+    return list(_worker_model.encode(texts, batch_size=len(texts)))
+
+
+class EmbeddingPool:
+    """
+    Pool of worker processes, each holding its own copy of a SentenceTransformer model.
+    Batches are sharded across the workers and the results are streamed back in order.
+    """
+
+    def __init__(self, model_name: str, workers: int):
+        self.model_name = model_name
+        self.workers = workers
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_name, threads_per_worker),
+        )
+
+    def map(self, batches: Iterable[list[str]]) -> Iterator[list]:
+        """Encode each batch in a worker and yield the results in input order."""
+        return self._executor.map(_encode_shard, batches)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_embedding_pool(model_name: str, workers: int) -> EmbeddingPool:
+    """Return the process-wide pool for (model_name, workers), starting it on first use."""
+    with _pools_lock:
+        pool = _pools.get((model_name, workers))
+        if pool is None:
+            pool = EmbeddingPool(model_name, workers)
+            _pools[(model_name, workers)] = pool
+    return pool
+
+
+@atexit.register
+def shutdown_embedding_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
@@ -0,0 +1,44 @@
+import threading
+
+# Key properties of every node the ingestion code MERGEs. Chunks, parents and children
+# are keyed within their document, so the same position in two documents never collides.
+INGESTION_KEYS = {
+    "PDF": ("id",),
+    "Chunk": ("doc_id", "index"),
+    "Parent": ("pdf_id", "id"),
+    "Child": ("pdf_id", "id"),
+    "Book": ("id",),
+    "__Chunk__": ("book_id", "id"),
+    "__Entity__": ("name",),
+}
+
+_bootstrapped = set()
+_bootstrap_lock = threading.Lock()
+
+
+def constraint_name(label: str) -> str:
+    # Underscores are kept, so Chunk and __Chunk__ get distinct constraints
+    return f"{label.lower()}_key"
+
+
+def constraint_query(label: str, properties: tuple[str, ...]) -> str:
+    """Uniqueness constraint on the (composite) key; its backing index turns each MERGE into an index seek."""
+    key = ", ".join(f"n.`{prop}`" for prop in properties)
+    return f"CREATE CONSTRAINT {constraint_name(label)} IF NOT EXISTS FOR (n:`{label}`) REQUIRE ({key}) IS UNIQUE"
+
+
+def ensure_ingestion_schema(driver, labels: list[str] = None):
+    """
+    Create the key constraints for labels (default: all of INGESTION_KEYS) and wait for
+    their indexes to come online. Runs once per label and process, so import functions
+    can call it unconditionally.
+    """
+    labels = list(INGESTION_KEYS) if labels is None else labels
+    with _bootstrap_lock:
+        missing = [label for label in labels if label not in _bootstrapped]
+        if not missing:
+            return
+        for label in missing:
+            driver.execute_query(constraint_query(label, INGESTION_KEYS[label]))
+        driver.execute_query("CALL db.awaitIndexes(300)")
+        _bootstrapped.update(missing)
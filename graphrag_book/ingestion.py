@@ -0,0 +1,133 @@
+import queue
+import threading
+from bisect import bisect_right
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+_DONE = object()
+_STOPPED = object()
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def iter_text_chunks(pieces: Iterable[str], chunk_size: int, overlap: int, with_pages: bool = False) -> Iterator:
+    """
+    Streaming version of utils.chunk_text with split_on_whitespaces=True.
+
+    Consumes the text piece by piece (e.g. page by page) and yields the same chunks
+    chunk_text would return for the concatenated text, while only buffering the
+    text that the next chunk can still reach back into. With with_pages=True it
+    yields (chunk, piece number where the chunk starts) pairs instead.
+    """
+    buffer = ""
+    index = 0
+    # Offset of buffer[0] in the whole text, and offset at which each piece starts
+    consumed = 0
+    piece_starts = []
+
+    def emit(start, end):
+        chunk = buffer[start:end].strip()
+        if not with_pages:
+            return chunk
+        return chunk, bisect_right(piece_starts, consumed + start) - 1
+
+    for piece in pieces:
+        piece_starts.append(consumed + len(buffer))
+        buffer += piece
+        while True:
+            next_whitespace = buffer.find(" ", index + chunk_size)
+            if next_whitespace == -1:
+                break
+            yield emit(_prev_whitespace(buffer, index, overlap), next_whitespace)
+            index = next_whitespace + 1
+            # Everything before the next chunk's left boundary is no longer needed
+            cut = _prev_whitespace(buffer, index, overlap)
+            if cut > 0:
+                buffer = buffer[cut:]
+                index -= cut
+                consumed += cut
+    while index < len(buffer):
+        next_whitespace = buffer.find(" ", index + chunk_size)
+        if next_whitespace == -1:
+            next_whitespace = len(buffer)
+        yield emit(_prev_whitespace(buffer, index, overlap), next_whitespace)
+        index = next_whitespace + 1
+
+
+def _prev_whitespace(buffer: str, index: int, overlap: int) -> int:
+    if index - overlap < 0:
+        return 0
+    return max(buffer.rfind(" ", 0, index - overlap + 1), 0)
+
+
+def run_stages(source: Iterable, stages: list[Callable], queue_size: int = 4) -> Iterator:
+    """
+    Run each stage in its own thread, connected by bounded queues, and yield the
+    outputs of the last stage. A full queue blocks the stage feeding it, so at most
+    queue_size items are in flight between two stages and memory stays flat.
+    Exceptions raised in any stage are re-raised in the consumer.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(q):
+        # Returns _STOPPED once the consumer has stopped, so stage threads never block forever
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOPPED
+
+    def feed():
+        try:
+            for item in source:
+                if stop.is_set():
+                    return
+                put(queues[0], item)
+        except BaseException as e:
+            put(queues[0], e)
+            return
+        put(queues[0], _DONE)
+
+    def work(stage, inbox, outbox):
+        while True:
+            item = get(inbox)
+            if item is _STOPPED:
+                return
+            if item is _DONE or isinstance(item, BaseException):
+                put(outbox, item)
+                return
+            try:
+                put(outbox, stage(item))
+            except BaseException as e:
+                put(outbox, e)
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages):
+        threads.append(threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,71 @@
+import os
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import pdfplumber
+
+
+def iter_pdf_pages(pdf_path: str) -> Iterator[str]:
+    """Yield the text of each page, releasing the page's layout objects once it is extracted."""
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text() or ""
+            page.flush_cache()
+            yield text
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> list[str]:
+    texts = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages[start:end]:
+            texts.append(page.extract_text() or "")
+            page.flush_cache()
+    return texts
+
+
+def extract_pdf_text(pdf_path: str, workers: int = None, pages_per_task: int = 8) -> tuple[str, list[int]]:
+    """
+    Extract the text of a PDF with page ranges spread over worker processes.
+
+    Returns the concatenated text and the character offset at which each page starts,
+    so chunk offsets can be mapped back to page numbers with page_for_offset.
+    """
+    with pdfplumber.open(pdf_path) as pdf:
+        num_pages = len(pdf.pages)
+    ranges = [(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)]
+    workers = min(workers or os.cpu_count() or 1, max(len(ranges), 1))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            page_texts = executor.map(_extract_page_range, [pdf_path] * len(ranges), *zip(*ranges))
+            pages = [text for texts in page_texts for text in texts]
+    else:
+        pages = list(iter_pdf_pages(pdf_path))
+    page_offsets = []
+    offset = 0
+    for text in pages:
+        page_offsets.append(offset)
+        offset += len(text)
+    return "".join(pages), page_offsets
+
+
+def page_for_offset(page_offsets: list[int], offset: int) -> int:
+    """Return the 0-based page number containing the character at offset."""
+    return max(bisect_right(page_offsets, offset) - 1, 0)
+
+
+def locate_chunks(text: str, chunks: list[str], probe: int = 64) -> list[int]:
+    """
+    Character offset in text of each chunk, for chunks taken from text in order (they may
+    overlap or have had whitespace stripped). The first line of each chunk, up to probe
+    characters, is searched from the previous chunk's offset; a chunk that is not found
+    gets that previous offset.
+    """
+    offsets, cursor = [], 0
+    for chunk in chunks:
+        needle = chunk[:probe].split("\n", 1)[0]
+        position = text.find(needle, cursor) if needle else -1
+        if position != -1:
+            cursor = position
+        offsets.append(cursor)
+    return offsets
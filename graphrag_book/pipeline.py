@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from typing import Callable
+
+
+class PipelineManifest:
+    """
+    Persistent record of completed pipeline stages and of the completed items
+    (chunks, entities, communities, ...) inside each stage. Stage updates rewrite
+    the manifest atomically; finished items are appended to a per-stage JSONL log
+    next to it, which is dropped once the stage completes. A crash loses at most
+    the item in progress.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = {"stages": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._data = json.load(f)
+        self._items = {name: set(stage["items"]) | self._read_item_log(name)
+                       for name, stage in self._data["stages"].items()}
+
+    def _item_log_path(self, stage_name: str) -> str:
+        return f"{self.path}.{stage_name}.items.jsonl"
+
+    def _read_item_log(self, stage_name: str) -> set:
+        path = self._item_log_path(stage_name)
+        if not os.path.exists(path):
+            return set()
+        items = set()
+        with open(path) as f:
+            for line in f:
+                try:
+                    items.add(json.loads(line))
+                except json.JSONDecodeError:
+                    # A line cut short by a crash: that item was not finished
+                    continue
+        return items
+
+    def _remove_item_log(self, stage_name: str):
+        path = self._item_log_path(stage_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _stage(self, name: str) -> dict:
+        if name not in self._data["stages"]:
+            self._data["stages"][name] = {"done": False, "items": []}
+            self._items[name] = set()
+        return self._data["stages"][name]
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._data, f)
+        os.replace(tmp_path, self.path)
+
+    def is_stage_done(self, name: str) -> bool:
+        return self._data["stages"].get(name, {}).get("done", False)
+
+    def mark_stage_done(self, name: str):
+        with self._lock:
+            stage = self._stage(name)
+            stage["done"] = True
+            # Item keys are only needed to resume an unfinished stage
+            stage["items"] = []
+            self._items[name] = set()
+            self._save()
+            self._remove_item_log(name)
+
+    def is_item_done(self, stage_name: str, key: str) -> bool:
+        return key in self._items.get(stage_name, ())
+
+    def mark_item_done(self, stage_name: str, key: str):
+        with self._lock:
+            if stage_name not in self._data["stages"]:
+                self._stage(stage_name)
+                self._save()
+            if key not in self._items[stage_name]:
+                self._items[stage_name].add(key)
+                # Appending keeps each item O(1) instead of rewriting the whole manifest
+                with open(self._item_log_path(stage_name), "a") as f:
+                    f.write(json.dumps(key) + "\n")
+
+    def reset(self, stage_name: str = None):
+        """Forget a stage (or every stage), so it runs again from scratch."""
+        with self._lock:
+            names = list(self._data["stages"]) if stage_name is None else [stage_name]
+            for name in names:
+                # Logs go first, so a crash cannot leave one behind for a stage that is later re-created
+                self._remove_item_log(name)
+                self._data["stages"].pop(name, None)
+                self._items.pop(name, None)
+            self._save()
+
+
+class StageCheckpoint:
+    """Item-level checkpoint handed to a stage function."""
+
+    def __init__(self, manifest: PipelineManifest, stage_name: str):
+        self.manifest = manifest
+        self.stage_name = stage_name
+
+    def done(self, key) -> bool:
+        return self.manifest.is_item_done(self.stage_name, str(key))
+
+    def mark(self, key):
+        self.manifest.mark_item_done(self.stage_name, str(key))
+
+
+class PipelineRunner:
+    """
+    Runs named stages in order. Finished stages are skipped on later runs, and an
+    interrupted stage is re-entered with its checkpoint, so it only redoes the
+    items that did not complete.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest = PipelineManifest(manifest_path)
+        self.stages = []
+
+    def add_stage(self, name: str, fn: Callable[[StageCheckpoint], None]) -> "PipelineRunner":
+        self.stages.append((name, fn))
+        return self
+
+    def run(self, stages: list[str] = None):
+        """Run all stages, or only the named ones, resuming from the manifest."""
+        for name, fn in self.stages:
+            if stages is not None and name not in stages:
+                continue
+            if self.manifest.is_stage_done(name):
+                print(f"Stage '{name}' already completed, skipping")
+                continue
+            print(f"Running stage '{name}'")
+            fn(StageCheckpoint(self.manifest, name))
+            self.manifest.mark_stage_done(name)
@@ -0,0 +1,107 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+# Models trained with Matryoshka representation learning keep most of their quality
+# when their vectors are simply cut to a prefix and renormalized.
+TRUNCATABLE_MODELS = {"text-embedding-3-small", "text-embedding-3-large"}
+
+
+class EmbeddingProjection:
+    """
+    Maps embeddings to a lower dimension, either with a PCA fitted on the corpus or by
+    truncation. The same projection must be applied at ingest and at query time, so it
+    is saved next to the vector index it was used for.
+    """
+
+    def __init__(self, method: str, dimensions: int, mean: Optional[np.ndarray] = None,
+                 components: Optional[np.ndarray] = None):
+        if method not in ("pca", "truncate"):
+            raise ValueError(f"Unsupported projection method: {method}")
+        self.method = method
+        self.dimensions = dimensions
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def fit(cls, vectors, dimensions: int, method: str = "pca") -> "EmbeddingProjection":
+        if method == "truncate":
+            return cls("truncate", dimensions)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if dimensions > min(vectors.shape):
+            raise ValueError(f"Cannot fit a {dimensions}-dimensional PCA on {vectors.shape[0]} vectors of size {vectors.shape[1]}")
+        mean = vectors.mean(axis=0)
+        _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+        return cls("pca", dimensions, mean, vt[:dimensions].astype(np.float32))
+
+    def transform(self, vectors) -> np.ndarray:
+        """Project one vector or a matrix of vectors and L2-normalize the result."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.method == "truncate":
+            projected = vectors[..., :self.dimensions]
+        else:
+            projected = (vectors - self.mean) @ self.components.T
+        norms = np.linalg.norm(projected, axis=-1, keepdims=True)
+        return projected / np.maximum(norms, 1e-12)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {"method": np.array(self.method), "dimensions": np.array(self.dimensions)}
+        if self.method == "pca":
+            arrays.update(mean=self.mean, components=self.components)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "EmbeddingProjection":
+        with np.load(path) as data:
+            method = str(data["method"])
+            if method == "pca":
+                return cls(method, int(data["dimensions"]), data["mean"], data["components"])
+            return cls(method, int(data["dimensions"]))
+
+
+_projections = {}
+
+
+def projection_path(index_name: str) -> str:
+    """Location of the projection used by a vector index (PROJECTION_DIR, default ./projections)."""
+    return os.path.join(os.getenv("PROJECTION_DIR", "projections"), f"{index_name}.projection.npz")
+
+
+def fit_projection_for_index(index_name: str, vectors, dimensions: int, model: str = None) -> EmbeddingProjection:
+    """Fit a projection for index_name (truncation for models that support it, PCA otherwise) and save it."""
+    method = "truncate" if model in TRUNCATABLE_MODELS else "pca"
+    projection = EmbeddingProjection.fit(vectors, dimensions, method)
+    projection.save(projection_path(index_name))
+    _projections[index_name] = projection
+    return projection
+
+
+def load_projection_for_index(index_name: str) -> Optional[EmbeddingProjection]:
+    """Return the projection saved for index_name, or None if the index uses full-size vectors."""
+    if index_name not in _projections:
+        path = projection_path(index_name)
+        _projections[index_name] = EmbeddingProjection.load(path) if os.path.exists(path) else None
+    return _projections[index_name]
+
+
+def project_for_index(index_name: str, vectors):
+    """
+    Apply the projection saved for index_name to one vector or a list of vectors; they are
+    returned unchanged if the index uses full-size vectors. Every write to and query of a
+    projected index has to go through this.
+    """
+    projection = load_projection_for_index(index_name)
+    if projection is None or len(vectors) == 0:
+        return vectors
+    projected = projection.transform(vectors)
+    return projected if projected.ndim == 1 else list(projected)
+
+
+def clear_projection_for_index(index_name: str) -> None:
+    """Forget the projection of index_name, e.g. when the index is rebuilt with full-size vectors."""
+    path = projection_path(index_name)
+    if os.path.exists(path):
+        os.remove(path)
+    _projections[index_name] = None
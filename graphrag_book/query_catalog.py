@@ -0,0 +1,237 @@
+import threading
+import time
+
+# Index names the catalog queries may be pointed at. Index names are passed as query
+# parameters, never spliced into the Cypher, but are still checked so callers cannot
+# probe arbitrary indexes; register new ones with QueryCatalog.allow.
+ALLOWED_IDENTIFIERS = {
+    "vector_index": {"pdf", "parent", "entities"},
+    "fulltext_index": {"pdfChunkFulltext"},
+}
+
+
+class CatalogQuery:
+    def __init__(self, name: str, cypher: str, identifiers: dict = None, params: dict = None):
+        self.name = name
+        self.cypher = cypher
+        # Parameter name -> identifier kind in ALLOWED_IDENTIFIERS
+        self.identifiers = identifiers or {}
+        # Representative parameter values, used to plan the query in warmup
+        self.params = params or {}
+        self.executions = 0
+        self.total_time = 0.0
+
+
+class QueryCatalog:
+    """
+    Named Cypher queries whose text never changes between calls: every value is a
+    parameter, so each query is planned once and then served from Neo4j's plan cache.
+    Identifier parameters (index names) are validated against an allow-list, and
+    executions are counted per query.
+    """
+
+    def __init__(self, allowed_identifiers: dict = None):
+        self.queries = {}
+        self.allowed_identifiers = {kind: set(names) for kind, names in (allowed_identifiers or ALLOWED_IDENTIFIERS).items()}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, cypher: str, identifiers: dict = None, params: dict = None) -> CatalogQuery:
+        if name in self.queries:
+            raise ValueError(f"Query {name} is already registered")
+        self.queries[name] = CatalogQuery(name, cypher, identifiers, params)
+        return self.queries[name]
+
+    def allow(self, kind: str, name: str):
+        """Add an identifier (e.g. a newly created index) to the allow-list of kind."""
+        self.allowed_identifiers.setdefault(kind, set()).add(name)
+
+    def validate_identifier(self, kind: str, name: str) -> str:
+        if name not in self.allowed_identifiers.get(kind, ()):
+            raise ValueError(f"{name!r} is not an allowed {kind}")
+        return name
+
+    def prepare(self, name: str, params: dict) -> CatalogQuery:
+        """Look up a query and validate its identifier parameters."""
+        query = self.queries[name]
+        for param, kind in query.identifiers.items():
+            self.validate_identifier(kind, params[param])
+        return query
+
+    def _record(self, query: CatalogQuery, elapsed: float):
+        with self._lock:
+            query.executions += 1
+            query.total_time += elapsed
+
+    def run(self, driver, name: str, **params):
+        query = self.prepare(name, params)
+        start = time.monotonic()
+        try:
+            return driver.execute_query(query.cypher, **params)
+        finally:
+            self._record(query, time.monotonic() - start)
+
+    async def arun(self, driver, name: str, **params):
+        """Same as run, for a neo4j AsyncDriver."""
+        query = self.prepare(name, params)
+        start = time.monotonic()
+        try:
+            return await driver.execute_query(query.cypher, **params)
+        finally:
+            self._record(query, time.monotonic() - start)
+
+    def warmup(self, driver, names: list[str] = None):
+        """
+        Plan the queries with EXPLAIN (nothing is executed) so the first real call hits the
+        plan cache. Each query is sent with its representative parameters, as a plan planned
+        without them does not match the parameter types of the real calls.
+        """
+        for name in names or self.queries:
+            try:
+                driver.execute_query("EXPLAIN " + self.queries[name].cypher, **self.queries[name].params)
+            except Exception as e:
+                print(f"Could not warm up query {name}: {e}")
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [{"name": q.name, "executions": q.executions, "total_time": q.total_time,
+                     "avg_time": q.total_time / q.executions if q.executions else 0.0}
+                    for q in self.queries.values()]
+
+    def start_plan_tracking(self, driver):
+        """Start Neo4j's query collection, which records compile and execution time per invocation."""
+        driver.execute_query("CALL db.stats.clear('QUERIES')")
+        driver.execute_query("CALL db.stats.collect('QUERIES')")
+
+    def plan_report(self, driver) -> list[dict]:
+        """
+        Count, per query text seen by the server since start_plan_tracking, how many
+        invocations spent time compiling, i.e. were planned instead of served from the
+        plan cache. Catalog queries are reported by name; anything else (ad hoc or
+        f-string built queries) is reported by its text, which makes replanning
+        offenders easy to spot.
+        """
+        names = {q.cypher.strip(): q.name for q in self.queries.values()}
+        records, _, _ = driver.execute_query("""
+        CALL db.stats.retrieve('QUERIES') YIELD data
+        RETURN data.query AS query, data.invocations AS invocations
+        """)
+        report = {}
+        for record in records:
+            text = record["query"].strip()
+            key = names.get(text, text)
+            entry = report.setdefault(key, {"query": key, "invocations": 0, "plannings": 0})
+            entry["invocations"] += len(record["invocations"])
+            entry["plannings"] += sum(1 for inv in record["invocations"] if inv.get("elapsedCompileTimeInUs", 0) > 0)
+        return sorted(report.values(), key=lambda entry: entry["plannings"], reverse=True)
+
+
+catalog = QueryCatalog()
+
+# Stand-in for a query embedding: only the parameter type matters for planning
+_EMBEDDING = [0.0] * 384
+
+catalog.register("chunk_by_index", """
+MATCH (c:Chunk {doc_id: $doc_id, index: $chunk_index})
+RETURN c.text AS text, c.embedding AS embedding
+""", params={"doc_id": "", "chunk_index": 0})
+
+
+catalog.register("vector_search", """
+CALL db.index.vector.queryNodes($index_name, $k, $question_embedding) YIELD node AS hits, score
+RETURN hits.text AS text, score, hits.index AS index
+""", identifiers={"index_name": "vector_index"},
+   params={"index_name": "pdf", "k": 5, "question_embedding": _EMBEDDING})
+
+# For indexes created with vector.quantization.enabled: the index only ranks candidates,
+# which are then rescored exactly against the full-precision vectors stored on the nodes.
+catalog.register("rescored_vector_search", """
+CALL db.index.vector.queryNodes($index_name, $k * $oversample, $question_embedding) YIELD node AS hits
+WITH hits, vector.similarity.cosine(hits.embedding, $question_embedding) AS score
+ORDER BY score DESC
+LIMIT toInteger($k)
+RETURN hits.text AS text, score, hits.index AS index
+""", identifiers={"index_name": "vector_index"},
+   params={"index_name": "pdf", "k": 5, "oversample": 4, "question_embedding": _EMBEDDING})
+
+catalog.register("hybrid_search", """
+CALL {
+    CALL db.index.vector.queryNodes($index_name, $k, $question_embedding) YIELD node, score
+    WITH collect({node:node, score:score}) AS nodes, max(score) AS max
+    UNWIND nodes AS n
+    //normalize scores
+    RETURN n.node AS node, (n.score / max) AS score
+    UNION
+    //keyword index
+    CALL db.index.fulltext.queryNodes($full_text_index_name, $question, {limit: $k}) YIELD node, score
+    WITH collect({node:node, score:score}) AS nodes, max(score) AS max
+    UNWIND nodes AS n
+    RETURN n.node AS node, (n.score / max) AS score
+}
+//deduplicate nodes
+WITH node, max(score) AS score ORDER BY score DESC LIMIT $k
+RETURN node, score
+""", identifiers={"index_name": "vector_index", "full_text_index_name": "fulltext_index"},
+   params={"index_name": "pdf", "full_text_index_name": "pdfChunkFulltext", "k": 5,
+           "question_embedding": _EMBEDDING, "question": ""})
+
+catalog.register("parent_retrieval", """
+CALL db.index.vector.queryNodes($index_name, $k * 4, $question_embedding)
+YIELD node, score
+MATCH (node)<-[:HAS_CHILD]-(parent)
+WITH parent, max(score) AS score
+RETURN parent.text AS text, score
+ORDER BY score DESC
+LIMIT toInteger($k)
+""", identifiers={"index_name": "vector_index"},
+   params={"index_name": "parent", "k": 10, "question_embedding": _EMBEDDING})
+
+catalog.register("rescored_parent_retrieval", """
+CALL db.index.vector.queryNodes($index_name, $k * 4 * $oversample, $question_embedding)
+YIELD node
+WITH node, vector.similarity.cosine(node.embedding, $question_embedding) AS score
+ORDER BY score DESC
+LIMIT toInteger($k * 4)
+MATCH (node)<-[:HAS_CHILD]-(parent)
+WITH parent, max(score) AS score
+RETURN parent.text AS text, score
+ORDER BY score DESC
+LIMIT toInteger($k)
+""", identifiers={"index_name": "vector_index"},
+   params={"index_name": "parent", "k": 10, "oversample": 4, "question_embedding": _EMBEDDING})
+
+catalog.register("local_search", """
+CALL db.index.vector.queryNodes('entities', $k, $embedding)
+YIELD node, score
+WITH collect(node) as nodes
+WITH collect {
+    UNWIND nodes as n
+    MATCH (n)<-[:HAS_ENTITY]->(c:__Chunk__)
+    WITH c, count(distinct n) as freq
+    RETURN c.text AS chunkText
+    ORDER BY freq DESC
+    LIMIT $topChunks
+} AS text_mapping,
+collect {
+    UNWIND nodes as n
+    MATCH (n)-[:IN_COMMUNITY]->(c:__Community__)
+    WITH c, c.rank as rank, c.weight AS weight
+    RETURN c.summary
+    ORDER BY rank, weight DESC
+    LIMIT $topCommunities
+} AS report_mapping,
+collect {
+    UNWIND nodes as n
+    MATCH (n)-[r:SUMMARIZED_RELATIONSHIP]-(m)
+    WHERE m IN nodes
+    RETURN r.summary AS descriptionText
+    ORDER BY r.rank, r.weight DESC
+    LIMIT $topInsideRels
+} as insideRels,
+collect {
+    UNWIND nodes as n
+    RETURN n.summary AS descriptionText
+} as entities
+RETURN {Chunks: text_mapping, Reports: report_mapping,
+       Relationships: insideRels,
+       Entities: entities} AS text
+""", params={"k": 5, "embedding": _EMBEDDING, "topChunks": 3, "topCommunities": 3, "topInsideRels": 3})
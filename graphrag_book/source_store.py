@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+import requests
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+class SourceStore:
+    """
+    Local store for downloaded source documents (PDFs, Gutenberg texts, ...).
+
+    Downloads are streamed to disk in chunks and stored under the SHA-256 of their
+    content; a small JSON record per URL points to the current blob together with
+    its ETag and Last-Modified headers. Later fetches are served from disk. With
+    revalidate=True a conditional request checks whether the remote file changed,
+    and in offline mode the network is never touched.
+    """
+
+    def __init__(self, root: str = None, offline: bool = None):
+        self.root = root or os.getenv("SOURCE_STORE_DIR", "sources")
+        self.offline = offline if offline is not None else os.getenv("SOURCE_STORE_OFFLINE") == "1"
+        os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "urls"), exist_ok=True)
+
+    def _record_path(self, url: str) -> str:
+        return os.path.join(self.root, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.root, "blobs", content_hash)
+
+    def _load_record(self, url: str) -> Optional[dict]:
+        path = self._record_path(url)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            record = json.load(f)
+        if not os.path.exists(self._blob_path(record["sha256"])):
+            return None
+        return record
+
+    def fetch(self, url: str, revalidate: bool = False) -> str:
+        """Return the local path of the document at url, downloading it only if needed."""
+        record = self._load_record(url)
+        if record is not None and (self.offline or not revalidate):
+            return self._blob_path(record["sha256"])
+        if self.offline:
+            raise FileNotFoundError(f"{url} is not in the source store at {self.root} and offline mode is on")
+
+        headers = {}
+        if record is not None:
+            if record.get("etag"):
+                headers["If-None-Match"] = record["etag"]
+            if record.get("last_modified"):
+                headers["If-Modified-Since"] = record["last_modified"]
+        with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 304:
+                return self._blob_path(record["sha256"])
+            response.raise_for_status()
+            digest = hashlib.sha256()
+            with tempfile.NamedTemporaryFile(dir=os.path.join(self.root, "blobs"), delete=False) as tmp:
+                try:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        tmp.write(chunk)
+                except BaseException:
+                    # Do not leave a partial download behind in blobs/
+                    tmp.close()
+                    os.remove(tmp.name)
+                    raise
+            content_hash = digest.hexdigest()
+            os.replace(tmp.name, self._blob_path(content_hash))
+            record = {
+                "url": url,
+                "sha256": content_hash,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+        with open(self._record_path(url), "w") as f:
+            json.dump(record, f)
+        return self._blob_path(content_hash)
+
+    def fetch_to(self, url: str, destination: str, revalidate: bool = False) -> str:
+        """Fetch url and copy it to destination (e.g. the file name a chapter expects)."""
+        shutil.copyfile(self.fetch(url, revalidate), destination)
+        return destination
+
+    def read_text(self, url: str, revalidate: bool = False, encoding: str = "utf-8") -> str:
+        with open(self.fetch(url, revalidate), encoding=encoding) as f:
+            return f.read()
+
+
+_default_store = None
+
+
+def get_source_store() -> SourceStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = SourceStore()
+    return _default_store
@@ -1,29 +1,117 @@
+import atexit
+import hashlib
 import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterator
+import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from sentence_transformers import SentenceTransformer
-from neo4j import GraphDatabase
+from neo4j import AsyncGraphDatabase, GraphDatabase
 import tiktoken
+from embedding_cache import EmbeddingCache
+from embedding_pool import get_embedding_pool
+from embedding_service import EmbeddingService
+from ingestion import batched
 
 load_dotenv(override=True)
 
 open_ai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_open_ai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-def create_ne4j_index(driver, index_name, embeddings):
-    driver.execute_query(
-        f"""CREATE VECTOR INDEX {index_name} IF NOT EXISTS
-        FOR (c:Chunk)
-        ON (c.embedding)
-        OPTIONS {{
-            indexConfig: {{
-                `vector.dimensions`: {len(embeddings[0])},
-                `vector.similarity_function`: 'cosine'
-            }}
-        }}"""
-    )
+# Process-wide registry of loaded embedding models, so every chapter shares one
+# warm instance per model instead of reloading it on each embed call.
+_embedding_models = {}
+_embedding_models_lock = threading.Lock()
+
+def get_embedding_model(model_name: str = "all-MiniLM-L12-v2") -> SentenceTransformer:
+    """Return the process-wide SentenceTransformer for model_name, loading it on first use."""
+    model = _embedding_models.get(model_name)
+    if model is None:
+        with _embedding_models_lock:
+            model = _embedding_models.get(model_name)
+            if model is None:
+                model = SentenceTransformer(model_name)
+                _embedding_models[model_name] = model
+    return model
+
+# One driver (and so one connection pool and routing table) per process, shared by all modules.
+_driver = None
+_driver_lock = threading.Lock()
+
+def get_driver():
+    """
+    Return the process-wide Neo4j driver, creating it on first use. Pooled connections idle for
+    longer than NEO4J_LIVENESS_CHECK_TIMEOUT seconds are checked before being handed out.
+    Callers must not close it; close_driver runs at interpreter exit.
+    """
+    global _driver
+    if _driver is None:
+        with _driver_lock:
+            if _driver is None:
+                driver = GraphDatabase.driver(
+                    os.getenv("NEO4J_URI"),
+                    auth=(os.getenv("NEO4J_USERNAME"), os.getenv("NEO4J_PASSWORD")),
+                    max_connection_pool_size=int(os.getenv("NEO4J_MAX_CONNECTION_POOL_SIZE", "50")),
+                    liveness_check_timeout=float(os.getenv("NEO4J_LIVENESS_CHECK_TIMEOUT", "30")),
+                )
+                driver.verify_connectivity()
+                _driver = driver
+    return _driver
+
+@atexit.register
+def close_driver():
+    """Close the shared driver and its connection pool."""
+    global _driver
+    with _driver_lock:
+        if _driver is not None:
+            _driver.close()
+            _driver = None
+
+_async_driver = None
+
+def get_async_driver():
+    """
+    Return the process-wide async Neo4j driver, configured like get_driver. It must be used
+    from a single event loop; close it with close_async_driver before the loop ends.
+    """
+    global _async_driver
+    if _async_driver is None:
+        _async_driver = AsyncGraphDatabase.driver(
+            os.getenv("NEO4J_URI"),
+            auth=(os.getenv("NEO4J_USERNAME"), os.getenv("NEO4J_PASSWORD")),
+            max_connection_pool_size=int(os.getenv("NEO4J_MAX_CONNECTION_POOL_SIZE", "50")),
+            liveness_check_timeout=float(os.getenv("NEO4J_LIVENESS_CHECK_TIMEOUT", "30")),
+        )
+    return _async_driver
 
-def neo4j_driver():
-    return GraphDatabase.driver(os.getenv("NEO4J_URI"), auth=(os.getenv("NEO4J_USERNAME"), os.getenv("NEO4J_PASSWORD")))
+async def close_async_driver():
+    global _async_driver
+    if _async_driver is not None:
+        await _async_driver.close()
+        _async_driver = None
+
+def write_in_batches(driver, query: str, rows, batch_size: int = 500, **params) -> int:
+    """
+    Write rows with query, which must read them with UNWIND $rows AS row, in batches of
+    batch_size. Each batch is its own managed write transaction, which the driver retries
+    on transient errors such as deadlocks or leader switches. Returns the number of rows.
+    """
+    start = time.monotonic()
+    total = 0
+    with driver.session() as session:
+        for batch in batched(rows, batch_size):
+            session.execute_write(lambda tx: tx.run(query, rows=batch, **params).consume())
+            total += len(batch)
+    elapsed = time.monotonic() - start
+    print(f"Wrote {total} rows in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f} rows/s)")
+    return total
 
 def clear_existing_data(driver):
     """Clear existing PDF data to avoid embedding dimension conflicts"""
@@ -45,54 +133,295 @@ def drop_vector_index(driver, index_name):
     except Exception as e:
         print(f"Error dropping index: {e}")
         
-def chunk_text(text: str, chunk_size: int, overlap: int, split_on_whitespaces: bool = True) -> list[str]:
+def content_hash(text: str) -> str:
+    """Stable SHA-256 hex digest of a text, used to detect changed documents and chunks."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _strip_span(text: str, start: int, end: int) -> tuple[int, int]:
+    """Shrink [start, end) so that text[start:end] == text[start:end].strip()."""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def chunk_offsets(text: str, chunk_size: int, overlap: int, split_on_whitespaces: bool = True) -> Iterator[tuple[int, int]]:
     """
-    Chunk text into chunks of a given size, with an overlap.
+    Lazily yield the (start, end) character offsets of the chunks chunk_text would return.
+    Whitespace positions are computed once and chunk boundaries found by binary search,
+    so the whole text is scanned a single time.
     """
-    chunks = []
     index = 0
-    while index < len(text):
-        if split_on_whitespaces:
+    if split_on_whitespaces:
+        # One pass over the text finds every space; works on any str, lone surrogates included
+        spaces = [match.start() for match in re.finditer(" ", text)]
+        while index < len(text):
             prev_whitespace = 0
-            left_index = index - overlap
-            while left_index >= 0:
-                if text[left_index] == " ":
-                    prev_whitespace = left_index
-                    break
-                left_index -= 1
-            next_whitespace = text.find(" ", index + chunk_size)
-            if next_whitespace == -1:
-                next_whitespace = len(text)
-            chunk = text[prev_whitespace:next_whitespace].strip()
-            chunks.append(chunk)
+            if index - overlap >= 0:
+                position = bisect_right(spaces, index - overlap) - 1
+                if position >= 0:
+                    prev_whitespace = spaces[position]
+            position = bisect_left(spaces, index + chunk_size)
+            next_whitespace = spaces[position] if position < len(spaces) else len(text)
+            yield _strip_span(text, prev_whitespace, next_whitespace)
             index = next_whitespace + 1
-        else:
+    else:
+        while index < len(text):
             start = max(0, index - overlap + 1)
             end = min(index + chunk_size + overlap, len(text))
-            chunk = text[start:end].strip()
-            chunks.append(chunk)
+            yield _strip_span(text, start, end)
             index = end
-    return chunks
+
+def chunk_text(text: str, chunk_size: int, overlap: int, split_on_whitespaces: bool = True) -> list[str]:
+    """
+    Chunk text into chunks of a given size, with an overlap.
+    """
+    return [text[start:end] for start, end in chunk_offsets(text, chunk_size, overlap, split_on_whitespaces)]
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-4") -> tiktoken.Encoding:
+    """Return the tiktoken encoding for model, loading it only once per process."""
+    return tiktoken.encoding_for_model(model)
 
 def num_tokens_from_string(string: str, model: str = "gpt-4") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
-def embed(text, model):
-    if model == "text-embedding-3-small":  
+def num_tokens_from_strings(strings: list[str], model: str = "gpt-4", num_threads: int = 8) -> list[int]:
+    """Returns the number of tokens of each string, tokenizing them in parallel."""
+    return [len(tokens) for tokens in get_encoding(model).encode_batch(strings, num_threads=num_threads)]
+
+def token_chunk_offsets(text: str, max_tokens: int, overlap_tokens: int, model: str = "gpt-4") -> Iterator[tuple[int, int]]:
+    """
+    Yield (start, end) character offsets of chunks of at most max_tokens tokens that
+    overlap by about overlap_tokens tokens. The text is tokenized once; cut points are
+    moved back to the nearest token that starts with whitespace, so words are not split.
+    """
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    _, starts = encoding.decode_with_offsets(tokens)
+    starts = starts + [len(text)]
+
+    def at_whitespace(position):
+        return starts[position] >= len(text) or text[starts[position]].isspace()
+
+    token_start = 0
+    while token_start < len(tokens):
+        cut = min(token_start + max_tokens, len(tokens))
+        if cut < len(tokens):
+            aligned = cut
+            while aligned > token_start + 1 and not at_whitespace(aligned):
+                aligned -= 1
+            if at_whitespace(aligned):
+                cut = aligned
+        start, end = _strip_span(text, starts[token_start], starts[cut])
+        if start < end:
+            yield start, end
+        if cut >= len(tokens):
+            break
+        next_start = max(cut - overlap_tokens, token_start + 1)
+        while next_start < cut and not at_whitespace(next_start):
+            next_start += 1
+        token_start = next_start
+
+def chunk_text_by_tokens(text: str, max_tokens: int, overlap_tokens: int, model: str = "gpt-4") -> list[str]:
+    """
+    Chunk text into chunks of at most max_tokens tokens, with an overlap of overlap_tokens tokens.
+    """
+    return [text[start:end] for start, end in token_chunk_offsets(text, max_tokens, overlap_tokens, model)]
+
+def _preprocess_document(document: str, chunk_size: int, overlap: int, model: str) -> dict:
+    chunks = chunk_text(document, chunk_size, overlap)
+    return {
+        "chunks": chunks,
+        "num_chars": len(document),
+        "num_tokens": num_tokens_from_string(document, model),
+        "num_chunks": len(chunks),
+    }
+
+def preprocess_documents(documents: list[str], chunk_size: int, overlap: int, workers: int = None, model: str = "gpt-4") -> list[dict]:
+    """
+    Chunk and count the tokens of many documents across a process pool.
+    Returns one dict per document, in input order, with its chunks and num_chars, num_tokens and num_chunks stats.
+    """
+    n = len(documents)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_preprocess_document, documents, [chunk_size] * n, [overlap] * n, [model] * n))
+
+# OpenAI rejects embedding requests with more than 2048 inputs or 300k tokens in total.
+OPENAI_MAX_EMBEDDING_INPUTS = 2048
+OPENAI_MAX_EMBEDDING_TOKENS = 300_000
+DEFAULT_EMBEDDING_BATCH_SIZE = 64
+
+def _encode_batch(texts: list[str], model: str):
+    if model == "text-embedding-3-small":
         response = open_ai_client.embeddings.create(
-            input=text,
+            input=texts,
             model="text-embedding-3-small"
         )
-        return list(map(lambda x: x.embedding, response.data))
+        return list(np.asarray([el.embedding for el in sorted(response.data, key=lambda x: x.index)], dtype=np.float32))
     elif model == "all-MiniLM-L12-v2":
-        model = SentenceTransformer("all-MiniLM-L12-v2")
-        if isinstance(text, str):
-            return [model.encode(text)]
-        else:
-            return list(map(lambda x: model.encode(x), text))
+        encoder = get_embedding_model("all-MiniLM-L12-v2")
+        return list(encoder.encode(texts, batch_size=len(texts)))
+    raise ValueError(f"Unsupported embedding model: {model}")
+
+# Set EMBEDDING_CACHE_DIR to persist embeddings between runs; unchanged texts are
+# then looked up by content hash instead of being embedded again.
+_embedding_caches = {}
+
+def get_embedding_cache(model_name: str):
+    """Return the on-disk embedding cache for model_name, or None when caching is disabled."""
+    cache_dir = os.getenv("EMBEDDING_CACHE_DIR")
+    if not cache_dir:
+        return None
+    with _embedding_models_lock:
+        cache = _embedding_caches.get(model_name)
+        if cache is None:
+            max_entries = os.getenv("EMBEDDING_CACHE_MAX_ENTRIES")
+            cache = EmbeddingCache(cache_dir, model_name, int(max_entries) if max_entries else None)
+            _embedding_caches[model_name] = cache
+    return cache
+
+@atexit.register
+def flush_embedding_caches():
+    """Persist the access ticks of the embedding caches; puts only append to their key logs."""
+    with _embedding_models_lock:
+        for cache in _embedding_caches.values():
+            cache.flush()
+
+def _token_budget_buckets(order: list[int], token_counts: list[int], batch_size: int, max_tokens: int) -> list[list[int]]:
+    """Split order into buckets of at most batch_size items and max_tokens tokens."""
+    buckets, bucket, bucket_tokens = [], [], 0
+    for i, tokens in zip(order, token_counts):
+        if bucket and (len(bucket) == batch_size or bucket_tokens + tokens > max_tokens):
+            buckets.append(bucket)
+            bucket, bucket_tokens = [], 0
+        bucket.append(i)
+        bucket_tokens += tokens
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+def embed_batch(texts: list[str], model: str, batch_size: int = None, use_cache: bool = True, workers: int = None) -> list:
+    """
+    Embed texts in batches of similar length and return the vectors in input order.
+    Texts already present in the embedding cache are not embedded again.
+    With workers > 1, local models encode the batches in a pool of worker processes.
+    """
+    if model == "text-embedding-3-small":
+        batch_size = min(batch_size or OPENAI_MAX_EMBEDDING_INPUTS, OPENAI_MAX_EMBEDDING_INPUTS)
+    else:
+        batch_size = batch_size or DEFAULT_EMBEDDING_BATCH_SIZE
+    cache = get_embedding_cache(model) if use_cache else None
+    embeddings = cache.get_many(texts) if cache else [None] * len(texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    # Sorting by length keeps padding inside each forward pass to a minimum.
+    order = sorted(missing, key=lambda i: len(texts[i]))
+    if model == "text-embedding-3-small":
+        buckets = _token_budget_buckets(order, num_tokens_from_strings([texts[i] for i in order], model), batch_size, OPENAI_MAX_EMBEDDING_TOKENS)
+    else:
+        buckets = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    batches = ([texts[i] for i in bucket] for bucket in buckets)
+    if workers and workers > 1 and model != "text-embedding-3-small":
+        results = get_embedding_pool(model, workers).map(batches)
+    else:
+        results = (_encode_batch(batch, model) for batch in batches)
+    for bucket, vectors in zip(buckets, results):
+        for i, vector in zip(bucket, vectors):
+            embeddings[i] = vector
+    if cache and missing:
+        cache.put_many([texts[i] for i in missing], [embeddings[i] for i in missing])
+    return embeddings
+
+def as_vector(embedding) -> np.ndarray:
+    """
+    float32 view of an embedding for a write parameter. The driver packs numpy arrays
+    directly, and db.create.setNodeVectorProperty stores them as a float32 vector
+    property, half the size of a list of Python floats stored with SET.
+    """
+    return np.asarray(embedding, dtype=np.float32)
+
+def embed(text, model, workers: int = None):
+    if isinstance(text, str):
+        text = [text]
+    return embed_batch(text, model, workers=workers)
+
+_embedding_services = {}
+
+def get_embedding_service(model_name: str) -> EmbeddingService:
+    """Return the process-wide micro-batching service that embeds queries for model_name."""
+    with _embedding_models_lock:
+        service = _embedding_services.get(model_name)
+        if service is None:
+            # Questions are cached by query_embedding_cache; going through the on-disk cache
+            # here would rewrite its key files on the request path for every new question
+            service = EmbeddingService(
+                lambda texts: embed_batch(texts, model_name, use_cache=False),
+                max_batch_size=int(os.getenv("EMBEDDING_SERVICE_MAX_BATCH", "32")),
+                max_wait=float(os.getenv("EMBEDDING_SERVICE_MAX_WAIT", "0.005")),
+            )
+            _embedding_services[model_name] = service
+    return service
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU of question embeddings keyed by (model, normalized question), with an optional TTL.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return " ".join(question.lower().split())
+
+    def get(self, question: str, model: str):
+        key = (model, self.normalize(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, question: str, model: str, embedding) -> None:
+        key = (model, self.normalize(question))
+        with self._lock:
+            self._entries[key] = (embedding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+query_embedding_cache = QueryEmbeddingCache(
+    max_size=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("QUERY_EMBEDDING_CACHE_TTL")) if os.getenv("QUERY_EMBEDDING_CACHE_TTL") else None,
+)
+
+def embed_query(question: str, model: str = "all-MiniLM-L12-v2"):
+    """
+    Embed a single question, batching it with questions submitted concurrently by other threads.
+    Repeated questions are answered from the shared query embedding cache.
+    """
+    embedding = query_embedding_cache.get(question, model)
+    if embedding is None:
+        embedding = get_embedding_service(model).embed(question)
+        query_embedding_cache.put(question, model, embedding)
+    return embedding
 
 def chat(messages, model="gpt-4o-mini", temp=0.0, config={}):
     response = open_ai_client.chat.completions.create(
@@ -103,6 +432,16 @@ def chat(messages, model="gpt-4o-mini", temp=0.0, config={}):
     )
     return response.choices[0].message.content
 
+async def achat(messages, model="gpt-4o-mini", temp=0.0, config={}):
+    """Awaitable chat, so LLM calls can run on the same event loop as async retrieval."""
+    response = await async_open_ai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temp,
+        **config
+    )
+    return response.choices[0].message.content
+
 def tool_choice(messages, model="gpt-4o", temperature=0, tools=[], config={}):
     response = open_ai_client.chat.completions.create(
         model=model,
@@ -0,0 +1,134 @@
+import re
+import time
+
+from projection import load_projection_for_index
+from query_catalog import catalog
+
+# Output size of the embedding models used in the book.
+MODEL_DIMENSIONS = {
+    "all-MiniLM-L12-v2": 384,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _identifier(name: str) -> str:
+    # Index names, labels and properties cannot be query parameters in DDL
+    if not _IDENTIFIER.match(name):
+        raise ValueError(f"Invalid identifier: {name!r}")
+    return f"`{name}`"
+
+
+def index_dimensions(index_name: str, model: str) -> int:
+    """Dimensions of the vectors stored in index_name: those of its projection if it has one, else the model's."""
+    projection = load_projection_for_index(index_name)
+    if projection is not None:
+        return projection.dimensions
+    if model not in MODEL_DIMENSIONS:
+        raise ValueError(f"Unknown dimensions for embedding model {model}; pass dimensions explicitly")
+    return MODEL_DIMENSIONS[model]
+
+
+def vector_index_config(dimensions: int, similarity: str = "cosine", m: int = None,
+                        ef_construction: int = None, quantization: bool = None) -> dict:
+    """indexConfig of a vector index. HNSW and quantization settings need Neo4j 5.23 or later."""
+    if similarity not in ("cosine", "euclidean"):
+        raise ValueError(f"Unsupported similarity function: {similarity}")
+    config = {"vector.dimensions": int(dimensions), "vector.similarity_function": similarity}
+    if m is not None:
+        config["vector.hnsw.m"] = int(m)
+    if ef_construction is not None:
+        config["vector.hnsw.ef_construction"] = int(ef_construction)
+    if quantization is not None:
+        config["vector.quantization.enabled"] = bool(quantization)
+    return config
+
+
+def _describe_index(driver, index_name: str):
+    records, _, _ = driver.execute_query("""
+    SHOW VECTOR INDEXES YIELD name, state, populationPercent, labelsOrTypes, properties, options
+    WHERE name = $index_name
+    RETURN state, populationPercent, labelsOrTypes, properties, options.indexConfig AS config
+    """, index_name=index_name)
+    return records[0] if records else None
+
+
+def _indexed_model(driver, index_name: str):
+    records, _, _ = driver.execute_query(
+        "MATCH (i:__VectorIndex__ {name: $index_name}) RETURN i.model AS model", index_name=index_name)
+    return records[0]["model"] if records else None
+
+
+def _record_model(driver, index_name: str, model: str, dimensions: int):
+    # The index config only knows the dimensions; the model is kept to catch same-size model swaps
+    driver.execute_query("""
+    MERGE (i:__VectorIndex__ {name: $index_name})
+    SET i.model = $model, i.dimensions = $dimensions
+    """, index_name=index_name, model=model, dimensions=dimensions)
+
+
+def _config_matches(existing: dict, wanted: dict) -> bool:
+    return all(str(existing.get(key)).lower() == str(value).lower() for key, value in wanted.items())
+
+
+def drop_vector_index(driver, index_name: str):
+    driver.execute_query(f"DROP INDEX {_identifier(index_name)} IF EXISTS")
+    driver.execute_query("MATCH (i:__VectorIndex__ {name: $index_name}) DELETE i", index_name=index_name)
+
+
+def await_vector_index(driver, index_name: str, timeout: float = 300, poll_interval: float = 1.0):
+    """Block until index_name is ONLINE, so searches never run against a half-populated index."""
+    deadline = time.monotonic() + timeout
+    while True:
+        index = _describe_index(driver, index_name)
+        if index is None:
+            raise ValueError(f"Vector index {index_name} does not exist")
+        if index["state"] == "ONLINE":
+            return
+        if index["state"] == "FAILED":
+            raise RuntimeError(f"Vector index {index_name} failed to populate")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Vector index {index_name} is still {index['state']} ({index['populationPercent']:.0f}%) after {timeout}s")
+        print(f"Waiting for vector index {index_name}: {index['state']} {index['populationPercent']:.0f}%")
+        time.sleep(poll_interval)
+
+
+def ensure_vector_index(driver, index_name: str, label: str, model: str, property: str = "embedding",
+                        dimensions: int = None, similarity: str = "cosine", m: int = None,
+                        ef_construction: int = None, quantization: bool = None, timeout: float = 300) -> bool:
+    """
+    Create the vector index index_name on (label).property for vectors of model and wait
+    until it is ONLINE. Dimensions are derived from the model (or the index projection)
+    unless given. An existing index built for another model, another label or property,
+    or with other settings is dropped and rebuilt. Returns True if the index was (re)created,
+    in which case vectors written by a previous model have to be re-embedded.
+    """
+    dimensions = dimensions or index_dimensions(index_name, model)
+    config = vector_index_config(dimensions, similarity, m, ef_construction, quantization)
+    existing = _describe_index(driver, index_name)
+    if existing is not None:
+        unchanged = (existing["labelsOrTypes"] == [label] and existing["properties"] == [property]
+                     and _config_matches(existing["config"] or {}, config)
+                     and _indexed_model(driver, index_name) in (None, model))
+        if unchanged:
+            _record_model(driver, index_name, model, dimensions)
+            await_vector_index(driver, index_name, timeout)
+            catalog.allow("vector_index", index_name)
+            return False
+        print(f"Vector index {index_name} does not match model {model} and settings {config}, rebuilding it")
+        drop_vector_index(driver, index_name)
+
+    options = ", ".join(f"`{key}`: {str(value).lower() if isinstance(value, bool) else repr(value)}"
+                        for key, value in config.items())
+    driver.execute_query(
+        f"""CREATE VECTOR INDEX {_identifier(index_name)} IF NOT EXISTS
+        FOR (n:{_identifier(label)})
+        ON (n.{_identifier(property)})
+        OPTIONS {{indexConfig: {{{options}}}}}"""
+    )
+    _record_model(driver, index_name, model, dimensions)
+    await_vector_index(driver, index_name, timeout)
+    catalog.allow("vector_index", index_name)
+    return True
@@ -0,0 +1,206 @@
+import queue
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from typing import Callable
+
+from neo4j.exceptions import DriverError, Neo4jError
+
+from ingestion import batched
+
+_STOP = object()
+
+
+class WriteExecutor:
+    """
+    Runs Neo4j write transactions on a fixed number of worker threads, each with its
+    own session. Work is handed over through a bounded queue: when all workers are
+    busy and the queue is full, submit blocks, which slows down the producers
+    (embedding, LLM extraction) to the pace the database can absorb.
+    """
+
+    def __init__(self, driver, workers: int = 4, queue_size: int = None):
+        self.driver = driver
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size or workers * 2)
+        self._futures = []
+        self._error = None
+        self._threads = [threading.Thread(target=self._work, name=f"neo4j-writer-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        with self.driver.session() as session:
+            while True:
+                task = self._queue.get()
+                if task is _STOP:
+                    return
+                future, work, args, kwargs = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(session.execute_write(work, *args, **kwargs))
+                except BaseException as e:
+                    if self._error is None:
+                        self._error = e
+                    future.set_exception(e)
+
+    def submit(self, work: Callable, *args, **kwargs) -> Future:
+        """
+        Queue a transaction function work(tx, *args, **kwargs); blocks while the queue is full.
+        Re-raises the first failed write, so producers stop instead of doing work that cannot be stored.
+        """
+        if self._error is not None:
+            raise self._error
+        future = Future()
+        self._queue.put((future, work, args, kwargs))
+        self._futures.append(future)
+        return future
+
+    def submit_query(self, query: str, **params) -> Future:
+        return self.submit(_run_query, query, params)
+
+    def submit_batches(self, query: str, rows, batch_size: int = 500, **params) -> list[Future]:
+        """Queue query (reading UNWIND $rows AS row) once per batch of rows."""
+        return [self.submit_query(query, rows=batch, **params) for batch in batched(rows, batch_size)]
+
+    def wait(self):
+        """Block until all submitted work is done and re-raise the first failure."""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self) -> "WriteExecutor":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.shutdown()
+
+
+def _run_query(tx, query: str, params: dict):
+    summary = tx.run(query, **params).consume()
+    return summary.counters
+
+
+class PartitionedWriter:
+    """
+    Writes rows with an UNWIND $rows query on several workers without lock storms on
+    hot keys such as popular entities.
+
+    Each row is routed by a stable hash of key(row), so the node identified by the key
+    is only ever locked by one worker. Only use it for queries where that is the one
+    contended node per row, apart from nodes whose locks can be taken in a global
+    order: every batch is sorted by order(row) (default: the key), so such shared
+    nodes, e.g. the chunk a mention points to, are locked in ascending order by all
+    workers and cannot deadlock. Batches that still fail with a retryable error are
+    retried with exponential backoff and random jitter.
+    """
+
+    def __init__(self, driver, query: str, key: Callable[[dict], str], workers: int = 4,
+                 batch_size: int = 500, queue_size: int = 2, max_retries: int = 5,
+                 backoff: float = 0.1, order: Callable[[dict], tuple] = None, **params):
+        self.driver = driver
+        self.query = query
+        self.key = key
+        self.order = order or (lambda row: str(key(row)))
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.params = params
+        self._buffers = [[] for _ in range(workers)]
+        self._futures = []
+        self._error = None
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(q,), name=f"neo4j-partition-{i}", daemon=True)
+                         for i, q in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self, partition_queue: queue.Queue):
+        with self.driver.session() as session:
+            while True:
+                task = partition_queue.get()
+                if task is _STOP:
+                    return
+                future, rows = task
+                try:
+                    future.set_result(self._write(session, rows))
+                except BaseException as e:
+                    if self._error is None:
+                        self._error = e
+                    future.set_exception(e)
+
+    def _write(self, session, rows: list[dict]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with session.begin_transaction() as tx:
+                    summary = tx.run(self.query, rows=rows, **self.params).consume()
+                    tx.commit()
+                return summary.counters
+            except (Neo4jError, DriverError) as e:
+                if not e.is_retryable() or attempt == self.max_retries:
+                    raise
+                # Jitter keeps the transactions that deadlocked together from colliding again
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _partition(self, row: dict) -> int:
+        # crc32 rather than hash() so routing is the same in every process
+        return zlib.crc32(str(self.key(row)).encode("utf-8")) % len(self._queues)
+
+    def _submit(self, partition: int):
+        rows = sorted(self._buffers[partition], key=self.order)
+        self._buffers[partition] = []
+        if rows:
+            future = Future()
+            self._queues[partition].put((future, rows))
+            self._futures.append(future)
+
+    def add(self, rows):
+        """
+        Route rows to their partitions; full batches are queued, blocking while a partition is behind.
+        Re-raises the first failed write.
+        """
+        if self._error is not None:
+            raise self._error
+        for row in rows:
+            partition = self._partition(row)
+            self._buffers[partition].append(row)
+            if len(self._buffers[partition]) >= self.batch_size:
+                self._submit(partition)
+
+    def flush(self):
+        """Write all buffered rows and block until they are committed; re-raises the first failure."""
+        for partition in range(len(self._buffers)):
+            self._submit(partition)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        for partition_queue in self._queues:
+            partition_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self) -> "PartitionedWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.shutdown()
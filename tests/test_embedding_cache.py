@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "graphrag_book"))
+
+from embedding_cache import EmbeddingCache
+
+
+def _vectors(count, start=0):
+    return [np.full(4, start + i, dtype=np.float32) for i in range(count)]
+
+
+def test_reopen_with_lower_max_entries(tmp_path):
+    texts = [f"text {i}" for i in range(2000)]
+    cache = EmbeddingCache(str(tmp_path), "model")
+    cache.put_many(texts, _vectors(2000))
+    # The most recently used entries are the ones that survive the shrink
+    cache.get_many(texts[-50:])
+    cache.flush()
+
+    cache = EmbeddingCache(str(tmp_path), "model", max_entries=100)
+    assert len(cache) == 100
+    cache.put_many(["new"], _vectors(1, 5000))
+    assert len(cache) <= 100
+    assert cache.get_many(["new"])[0][0] == 5000
+    assert [v[0] for v in cache.get_many(texts[-50:])] == list(range(1950, 2000))
+    assert os.path.getsize(os.path.join(str(tmp_path), "model.vectors.f32")) <= 100 * 4 * 4
+
+
+def test_puts_survive_reopen_without_flush(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", max_entries=1500)
+    for start in range(0, 2000, 64):
+        cache.put_many([f"text {i}" for i in range(start, start + 64)], _vectors(64, start))
+
+    reopened = EmbeddingCache(str(tmp_path), "model", max_entries=1500)
+    assert len(reopened) == len(cache)
+    assert reopened.get_many(["text 1999"])[0][0] == 1999
+    assert reopened.get_many(["text 0"]) == [None]